@@ -0,0 +1,287 @@
+# 异步传输引擎: 连接在事件循环里收发，慢速客户端不再各占一个线程
+#   python asgi.py --workers 4
+#   uvicorn asgi:app --workers 4
+# /upload 的请求体和分块上传的 PUT 边收边交给磁盘线程池写入；其他路由收完请求体后交给 Flask 处理，
+# 下载的响应体在线程池里按块读出，再在事件循环里发送。路由和页面与 main.py 完全相同
+import argparse
+import asyncio
+import io
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.wrappers import Request
+
+from main import app as flask_app, active_transfers, chunk_options, MultipartIngest, open_chunk, start_progress, \
+    transfer_options
+
+config = flask_app.config
+# 每个连接同时只在内存里保留一块数据，块小一些才能撑住上千个连接
+config['DOWNLOAD_BLOCK_SIZE'] = min(config['DOWNLOAD_BLOCK_SIZE'], config['ASYNC_BLOCK_SIZE'])
+
+disk_pool = ThreadPoolExecutor(config['ASYNC_DISK_THREADS'], thread_name_prefix='disk')
+app_pool = ThreadPoolExecutor(config['ASYNC_APP_THREADS'], thread_name_prefix='flask')
+url_adapter = flask_app.url_map.bind('localhost')
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'transfer.async': True,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+async def watch_disconnect(receive, disconnected):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    disconnected.set()
+
+
+async def respond(environ, receive, send, wsgi_app=flask_app):
+    # 应用在 app_pool 里生成响应，响应体在 disk_pool 里逐块读出；send 会等到发送缓冲腾出空间再返回
+    # 限速的下载在发送前按令牌桶在事件循环里等待，不占线程
+    loop = asyncio.get_running_loop()
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def call():
+        body = wsgi_app(environ, start_response)
+        return body, iter(body)
+
+    body, chunks = await loop.run_in_executor(app_pool, call)
+    stream = environ.get('transfer.stream')
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(watch_disconnect(receive, disconnected))
+    try:
+        data = await loop.run_in_executor(disk_pool, next, chunks, None)
+        await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        while data is not None and not disconnected.is_set():
+            if data:
+                if stream is not None:
+                    delay = stream.reserve(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            data = await loop.run_in_executor(disk_pool, next, chunks, None)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        watcher.cancel()
+        if hasattr(body, 'close'):
+            await loop.run_in_executor(disk_pool, body.close)
+
+
+async def receive_body(receive):
+    # 小请求体留在内存里，超过一块的部分写进临时文件，写文件同样交给线程池
+    loop = asyncio.get_running_loop()
+    body = tempfile.SpooledTemporaryFile(config['ASYNC_BLOCK_SIZE'],
+                                         dir=os.path.join(config['UPLOAD_FOLDER'], '.incoming'))
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('客户端断开连接')
+        data = message.get('body', b'')
+        size += len(data)
+        if config['MAX_CONTENT_LENGTH'] and size > config['MAX_CONTENT_LENGTH']:
+            raise RequestEntityTooLarge()
+        if data:
+            if size > config['ASYNC_BLOCK_SIZE']:
+                await loop.run_in_executor(disk_pool, body.write, data)
+            else:
+                body.write(data)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body
+
+
+async def ingest_upload(receive, boundary, environ):
+    # 收到的数据攒够一块就交给线程池解析、计算摘要和写盘，事件循环本身不碰磁盘
+    loop = asyncio.get_running_loop()
+    length = environ.get('CONTENT_LENGTH')
+    progress = await loop.run_in_executor(disk_pool, start_progress,
+                                          dict(parse_qsl(environ['QUERY_STRING'])).get('progress'),
+                                          int(length) if length and length.isdigit() else None)
+    environ['transfer.progress'] = progress
+    ingest = MultipartIngest(boundary, config['ASYNC_BLOCK_SIZE'], progress)
+    pending = bytearray()
+    started = time.monotonic()
+    active_transfers.inc(labels=('upload',))
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('客户端断开连接')
+            pending += message.get('body', b'')
+            if config['MAX_CONTENT_LENGTH'] and ingest.received + len(pending) > config['MAX_CONTENT_LENGTH']:
+                raise RequestEntityTooLarge()
+            more = message.get('more_body', False)
+            if len(pending) >= config['ASYNC_BLOCK_SIZE'] or (pending and not more):
+                data = bytes(pending)
+                pending.clear()
+                await loop.run_in_executor(disk_pool, ingest.feed, data)
+            if not more:
+                break
+        await loop.run_in_executor(disk_pool, ingest.feed, None)
+        environ['transfer.ingested'] = (ingest.files, ingest.received, time.monotonic() - started)
+    except Exception as e:
+        await loop.run_in_executor(disk_pool, ingest.abort)
+        environ['transfer.ingested'] = e
+    finally:
+        active_transfers.dec(labels=('upload',))
+
+
+async def ingest_chunk(receive, chunk, environ):
+    # 分块边收边在磁盘线程里定位写入分块文件，不先落到临时文件，每个字节只写一次盘
+    loop = asyncio.get_running_loop()
+    pending = bytearray()
+    active_transfers.inc(labels=('upload',))
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('客户端断开连接')
+            pending += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(pending) >= config['ASYNC_BLOCK_SIZE'] or (pending and not more):
+                data = bytes(pending)
+                pending.clear()
+                await loop.run_in_executor(disk_pool, chunk.feed, data)
+            if not more:
+                break
+        environ['transfer.ingested'] = await loop.run_in_executor(disk_pool, chunk.close)
+    except Exception as e:
+        await loop.run_in_executor(disk_pool, chunk.close)
+        environ['transfer.ingested'] = e
+    finally:
+        active_transfers.dec(labels=('upload',))
+
+
+async def native_chunk(scope, environ):
+    # 有效的分块请求返回 ChunkIngest；会话不存在、范围无效等情况交给 Flask 按原逻辑返回错误
+    try:
+        endpoint, values = url_adapter.match(scope['path'], scope['method'])
+    except HTTPException:
+        return None
+    if endpoint != 'upload_chunk':
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        chunk, _ = await loop.run_in_executor(disk_pool, open_chunk, values['upload_id'], values['index'],
+                                              *chunk_options(Request(environ)))
+    except OSError:
+        return None
+    return chunk
+
+
+def native_upload(scope, environ):
+    # 只有合法的 multipart 上传走异步接收，其余情况交给 Flask 按原逻辑返回错误
+    try:
+        endpoint, _ = url_adapter.match(scope['path'], scope['method'])
+    except HTTPException:
+        return None
+    if endpoint != 'upload_file':
+        return None
+    mimetype, params = parse_options_header(environ.get('CONTENT_TYPE', ''))
+    if mimetype != 'multipart/form-data' or not params.get('boundary'):
+        return None
+    try:
+        transfer_options(dict(parse_qsl(environ['QUERY_STRING'])))
+    except ValueError:
+        return None
+    return params['boundary']
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                disk_pool.shutdown(wait=False)
+                app_pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    environ = build_environ(scope, io.BytesIO())
+    boundary = native_upload(scope, environ)
+    if boundary:
+        await ingest_upload(receive, boundary, environ)
+        await respond(environ, receive, send)
+        return
+    chunk = await native_chunk(scope, environ) if scope['method'] == 'PUT' else None
+    if chunk is not None:
+        await ingest_chunk(receive, chunk, environ)
+        await respond(environ, receive, send)
+        return
+    try:
+        environ['wsgi.input'] = await receive_body(receive)
+    except RequestEntityTooLarge as e:
+        await respond(environ, receive, send, wsgi_app=e)
+        return
+    except ConnectionError:
+        return
+    try:
+        await respond(environ, receive, send)
+    finally:
+        environ['wsgi.input'].close()
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='文件传输服务 (异步)')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=6789)
+    parser.add_argument('--workers', type=int, default=config['SERVER_WORKERS'])
+    args = parser.parse_args()
+    # 工作进程重新导入 main.py，通过环境变量得知进程数
+    os.environ['TRANSFER_SERVER_PROCESSES'] = str(args.workers)
+    uvicorn.run('asgi:app', host=args.host, port=args.port, workers=args.workers, lifespan='on',
+                limit_concurrency=config['ASYNC_CONNECTIONS'], backlog=config['SERVER_BACKLOG'],
+                timeout_keep_alive=config['SERVER_KEEPALIVE'],
+                timeout_graceful_shutdown=config['SERVER_GRACEFUL_TIMEOUT'])
+
+
+if __name__ == '__main__':
+    main()
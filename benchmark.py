@@ -0,0 +1,513 @@
+# 性能测试脚本
+#   python benchmark.py zip --files 8 --size-mb 32 --workers 1,2,4,8
+#   python benchmark.py load --server gunicorn --workers 4 --concurrency 32 --json new.json
+#   python benchmark.py compare old.json new.json
+#   python benchmark.py s3                       # 用 moto 模拟的对象存储检查 S3 后端 (pip install "moto[server]")
+#   python benchmark.py s3 --endpoint-url http://minio:9000 --bucket transfer-test --access-key ... --secret-key ...
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import S3Storage
+from zipstream import ZipStream
+
+try:
+    import psutil
+except ImportError:  # 没有 psutil 时在 Linux 上读 /proc，其他系统不统计 CPU 和内存
+    psutil = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = [b'GET', b'POST', b'/upload', b'/download/zip', b'200', b'404', b'INFO', b'ERROR',
+         b'timeout', b'user', b'session', b'127.0.0.1', b'Mozilla/5.0', b'chunk', b'finalize']
+
+
+def make_log_file(path, size):
+    rng = random.Random(path)
+    pool = [b' '.join(rng.choice(WORDS) for _ in range(12)) + b' %d\n' % rng.getrandbits(32) for _ in range(4096)]
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            lines = b''.join(rng.choices(pool, k=1024))
+            f.write(lines)
+            written += len(lines)
+
+
+def default_workers():
+    cpus = os.cpu_count() or 1
+    counts = [2 ** i for i in range(cpus.bit_length()) if 2 ** i < cpus] + [cpus]
+    return ','.join(str(count) for count in counts)
+
+
+def bench_zip(args):
+    workers_list = [int(w) for w in args.workers.split(',')]
+    with tempfile.TemporaryDirectory() as folder:
+        entries = []
+        for i in range(args.files):
+            path = os.path.join(folder, f'log{i}.txt')
+            make_log_file(path, args.size_mb * 1024 * 1024)
+            entries.append((path, f'log{i}.txt'))
+        total = sum(os.path.getsize(path) for path, _ in entries)
+
+        results = []
+        baseline = None
+        for workers in workers_list:
+            stream = ZipStream(entries, codec='deflate', level=args.level, block_size=args.block_size * 1024,
+                               workers=workers)
+            started = time.perf_counter()
+            cpu_started = time.process_time()
+            output = 0
+            for data in stream:
+                output += len(data)
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu_started
+            baseline = baseline or elapsed
+            result = {
+                'workers': workers,
+                'seconds': round(elapsed, 3),
+                'cpu_seconds': round(cpu, 3),
+                'input_mb_per_sec': round(total / elapsed / 1024 / 1024, 1),
+                'ratio': round(output / total, 4),
+                'speedup': round(baseline / elapsed, 2),
+            }
+            results.append(result)
+            print(f"workers={workers:<3} {result['seconds']:>8.3f}s {result['input_mb_per_sec']:>8.1f} MB/s "
+                  f"ratio={result['ratio']:.4f} speedup={result['speedup']:.2f}x")
+
+        if args.verify:
+            path = os.path.join(folder, 'check.zip')
+            with open(path, 'wb') as f:
+                for data in ZipStream(entries, level=args.level, workers=max(workers_list)):
+                    f.write(data)
+            with zipfile.ZipFile(path) as z:
+                bad = z.testzip()
+            print('校验结果:', '通过' if bad is None else f'损坏 {bad}')
+
+    report = {'benchmark': 'zip', 'cpu_count': os.cpu_count(), 'files': args.files, 'size_mb': args.size_mb,
+              'level': args.level, 'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_tree(pid):
+    # 服务器主进程及其所有子进程
+    if psutil is not None:
+        try:
+            parent = psutil.Process(pid)
+            return [pid] + [child.pid for child in parent.children(recursive=True)]
+        except psutil.Error:
+            return []
+    if not os.path.isdir('/proc'):
+        return []
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree = [pid]
+    for current in tree:
+        tree.extend(child for child, parent in parents.items() if parent == current)
+    return tree
+
+
+def process_stats(pid):
+    # (累计 CPU 秒数, 峰值常驻内存字节数)
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            cpu = process.cpu_times()
+            memory = process.memory_info()
+            return cpu.user + cpu.system, getattr(memory, 'peak_wset', memory.rss)
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            hwm = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM'))
+    except (OSError, StopIteration, ValueError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), hwm
+
+
+class ServerMonitor:
+    # 每隔一段时间采样服务器各进程的 CPU 时间和峰值内存，退出的工作进程保留最后一次的数值
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.stats = {}
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        for pid in process_tree(self.pid):
+            stats = process_stats(pid)
+            if stats:
+                self.stats[pid] = stats
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self.sample()
+
+    def cpu_seconds(self):
+        return sum(cpu for cpu, _ in self.stats.values())
+
+    def peak_rss_mb(self):
+        return round(sum(rss for _, rss in self.stats.values()) / 1024 / 1024, 1)
+
+
+def start_server(args, folder):
+    port = free_port()
+    if args.server == 'asgi':
+        command = [sys.executable, os.path.join(ROOT, 'asgi.py'), '--port', str(port), '--workers', str(args.workers)]
+    else:
+        command = [sys.executable, os.path.join(ROOT, 'main.py'), '--server', args.server, '--port', str(port),
+                   '--workers', str(args.workers), '--threads', str(args.threads)]
+    env = dict(os.environ, TRANSFER_UPLOAD_FOLDER=os.path.join(folder, 'uploads'))
+    log = open(os.path.join(folder, 'server.log'), 'wb')
+    process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            log.close()
+            with open(os.path.join(folder, 'server.log'), 'rb') as f:
+                raise RuntimeError('服务器启动失败:\n' + f.read().decode(errors='replace'))
+        try:
+            status, _ = request(port, 'GET', '/')
+            if status == 200:
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('服务器启动超时')
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        size = 0
+        while True:
+            data = response.read(1024 * 1024)
+            if not data:
+                break
+            size += len(data)
+        return response.status, size
+    finally:
+        conn.close()
+
+
+def multipart(files, boundary='benchmark-boundary'):
+    parts = []
+    for name, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def upload(port, files):
+    body, headers = multipart(files)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request('POST', '/upload', body=body, headers=headers)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_scenario(name, args, monitor, make_request):
+    # make_request(i) -> (状态码, 传输的字节数)；并发 args.concurrency 个请求，共 args.count 个
+    def one(i):
+        started = time.perf_counter()
+        try:
+            status, size = make_request(i)
+        except OSError:
+            status, size = 0, 0
+        return time.perf_counter() - started, status, size
+
+    monitor.sample()
+    cpu_started = monitor.cpu_seconds()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(one, range(args.count)))
+    elapsed = time.perf_counter() - started
+    monitor.sample()
+
+    latencies = [latency for latency, status, _ in results if 200 <= status < 400]
+    total = sum(size for _, status, size in results if 200 <= status < 400)
+    result = {
+        'requests': args.count,
+        'errors': args.count - len(latencies),
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'mb_per_sec': round(total / elapsed / 1024 / 1024, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'server_cpu_seconds': round(monitor.cpu_seconds() - cpu_started, 2),
+        'server_peak_rss_mb': monitor.peak_rss_mb(),
+    }
+    print(f"{name:<9} {result['requests_per_sec']:>8.1f} req/s {result['mb_per_sec']:>8.1f} MB/s "
+          f"p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms cpu={result['server_cpu_seconds']:.2f}s "
+          f"rss={result['server_peak_rss_mb']}MB errors={result['errors']}")
+    return result
+
+
+def bench_load(args):
+    size = args.size_kb * 1024
+    scenarios = args.scenarios.split(',')
+    with tempfile.TemporaryDirectory() as folder:
+        payload = os.urandom(size)
+        process, port = start_server(args, folder)
+        monitor = ServerMonitor(process.pid)
+        monitor.thread.start()
+        results = {}
+        try:
+            # 下载用的文件先传好；每次上传的内容都不同，避免被去重直接跳过
+            single = upload(port, [('bench.bin', payload)])
+            log_path = os.path.join(folder, 'bench.log')
+            make_log_file(log_path, size)
+            with open(log_path, 'rb') as f:
+                text = f.read()
+            bundle = upload(port, [(f'bench{i}.log', text) for i in range(args.files)])
+            file_path = '/download/' + single['download_link'].split('/download/', 1)[1]
+            zip_path = '/download/' + bundle['download_link'].split('/download/', 1)[1]
+
+            for name in scenarios:
+                if name == 'upload':
+                    def make_request(i):
+                        body, headers = multipart([(f'up{i}-{j}.bin', os.urandom(16) + payload)
+                                                   for j in range(args.files)])
+                        status, _ = request(port, 'POST', '/upload', body, headers)
+                        return status, len(body)
+                elif name == 'download':
+                    def make_request(i):
+                        return request(port, 'GET', file_path)
+                elif name == 'zip':
+                    def make_request(i):
+                        return request(port, 'GET', zip_path)
+                elif name == 'pickup':
+                    def make_request(i):
+                        return request(port, 'POST', '/download/pickup', f'pickup_code={single["pickup_code"]}',
+                                       {'Content-Type': 'application/x-www-form-urlencoded'})
+                else:
+                    raise SystemExit(f'未知的测试场景: {name}')
+                results[name] = run_scenario(name, args, monitor, make_request)
+        finally:
+            monitor.stop.set()
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                  text=True).stdout.strip()
+    except OSError:
+        revision = ''
+    report = {'benchmark': 'load', 'revision': revision, 'cpu_count': os.cpu_count(), 'server': args.server,
+              'workers': args.workers, 'threads': args.threads, 'concurrency': args.concurrency,
+              'count': args.count, 'files': args.files, 'size_kb': args.size_kb, 'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+# 比较时各指标越大越好 (1) 还是越小越好 (-1)
+COMPARE_METRICS = {'requests_per_sec': 1, 'mb_per_sec': 1, 'p50_ms': -1, 'p99_ms': -1,
+                   'server_cpu_seconds': -1, 'server_peak_rss_mb': -1}
+
+
+def bench_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old.get('benchmark') != 'load' or new.get('benchmark') != 'load':
+        raise SystemExit('只能比较 load 测试的结果')
+
+    regressions = []
+    print(f"{old.get('revision') or args.old} -> {new.get('revision') or args.new}")
+    for scenario, before in old['results'].items():
+        after = new['results'].get(scenario)
+        if after is None:
+            continue
+        changes = []
+        for metric, direction in COMPARE_METRICS.items():
+            if not before.get(metric):
+                continue
+            change = (after[metric] - before[metric]) / before[metric] * 100
+            changes.append(f'{metric}={after[metric]} ({change:+.1f}%)')
+            if change * direction < -args.threshold:
+                regressions.append(f'{scenario}.{metric}')
+        print(f'{scenario:<9} ' + ' '.join(changes))
+    if regressions:
+        print('性能下降超过 {}%: {}'.format(args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+def bench_s3(args):
+    # 检查 S3 后端的分段上传、区间读取、可 seek 的读取和删除，并给出读写速度；任何一项不符时返回非 0
+    moto = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        from moto.server import ThreadedMotoServer
+
+        # moto 的每个请求都会打一行访问日志
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        port = free_port()
+        moto = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        moto.start()
+        endpoint_url = f'http://127.0.0.1:{port}'
+    failures = []
+
+    def check(name, ok):
+        print(f"{name:<32} {'通过' if ok else '失败'}")
+        if not ok:
+            failures.append(name)
+
+    try:
+        part_size = args.part_mb * 1024 * 1024
+        storage = S3Storage(args.bucket, 'check/', endpoint_url, 'us-east-1', args.access_key, args.secret_key,
+                            part_size)
+        if moto is not None:
+            storage._client().create_bucket(Bucket=args.bucket)
+        storage.prepare()
+
+        data = os.urandom(args.size_mb * 1024 * 1024 + 12345)
+        key = 'b' * 64
+        started = time.perf_counter()
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            storage.put_stream(key, f, len(data))
+        put_seconds = time.perf_counter() - started
+        head = storage._client().head_object(Bucket=args.bucket, Key='check/' + key)
+        parts = head['ETag'].strip('"').partition('-')[2]
+        check(f'分段上传 ({parts or 1} 段)', len(data) > part_size and int(parts or 1) == -(-len(data) // part_size))
+        check('stat 大小', storage.stat(key).st_size == len(data))
+
+        started = time.perf_counter()
+        whole = b''.join(storage.get_range(key, 0, len(data), 1024 * 1024))
+        get_seconds = time.perf_counter() - started
+        check('完整读取', whole == data)
+        start, stop = part_size - 100, part_size + 100
+        check('跨段的区间读取', b''.join(storage.get_range(key, start, stop, 64)) == data[start:stop])
+        check('起点在末尾的区间读取', b''.join(storage.get_range(key, len(data), len(data) + 10, 64)) == b'')
+
+        with storage.open(key) as reader:
+            ok = reader.read(10) == data[:10] and reader.tell() == 10
+            reader.seek(len(data) - 5)
+            ok = ok and reader.read() == data[-5:]
+            reader.seek(1000)
+            reader.seek(24, os.SEEK_CUR)
+            ok = ok and reader.read(8) == data[1024:1032] and reader.tell() == 1032
+            reader.seek(len(data))
+            ok = ok and reader.read(10) == b''
+        check('ObjectReader 读取和 seek', ok)
+
+        small = 'c' * 64
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b'small object')
+        storage.put_file(small, f.name)
+        check('小文件上传后删除暂存文件', not os.path.exists(f.name) and storage.stat(small).st_size == 12)
+        check('scan 列出对象', {key, small} <= {name for name, _ in storage.scan()})
+
+        storage.delete(key)
+        storage.delete(small)
+        check('删除后 stat 为 None', storage.stat(key) is None and storage.stat(small) is None)
+        try:
+            storage.open(key).read(1)
+            check('读取已删除的对象抛出 OSError', False)
+        except OSError:
+            check('读取已删除的对象抛出 OSError', True)
+
+        size_mb = len(data) / 1024 / 1024
+        print(f'写入 {size_mb / put_seconds:.1f} MB/s, 读取 {size_mb / get_seconds:.1f} MB/s ({endpoint_url})')
+    finally:
+        if moto is not None:
+            moto.stop()
+    if failures:
+        print('失败: ' + ', '.join(failures))
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文件传输性能测试')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    zip_parser = commands.add_parser('zip', help='打包压缩速度与线程数的关系')
+    zip_parser.add_argument('--files', type=int, default=8)
+    zip_parser.add_argument('--size-mb', type=int, default=32)
+    zip_parser.add_argument('--level', type=int, default=6)
+    zip_parser.add_argument('--block-size', type=int, default=1024, help='每块大小 (KiB)')
+    zip_parser.add_argument('--workers', default=default_workers(), help='逗号分隔的线程数列表')
+    zip_parser.add_argument('--verify', action='store_true')
+    zip_parser.add_argument('--json')
+    zip_parser.set_defaults(func=bench_zip)
+
+    load_parser = commands.add_parser('load', help='启动服务器，并发上传下载测吞吐量和延迟')
+    load_parser.add_argument('--server', choices=['gunicorn', 'waitress', 'dev', 'asgi'], default='gunicorn')
+    load_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    load_parser.add_argument('--threads', type=int, default=32)
+    load_parser.add_argument('--concurrency', type=int, default=16)
+    load_parser.add_argument('--count', type=int, default=200, help='每个场景的请求数')
+    load_parser.add_argument('--files', type=int, default=4, help='每次上传和打包的文件数')
+    load_parser.add_argument('--size-kb', type=int, default=1024, help='每个文件的大小 (KiB)')
+    load_parser.add_argument('--scenarios', default='upload,download,zip,pickup')
+    load_parser.add_argument('--json')
+    load_parser.set_defaults(func=bench_load)
+
+    compare_parser = commands.add_parser('compare', help='比较两次 load 测试的结果')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10, help='允许的变化百分比')
+    compare_parser.set_defaults(func=bench_compare)
+
+    s3_parser = commands.add_parser('s3', help='检查 S3 存储后端，不指定 --endpoint-url 时启动 moto')
+    s3_parser.add_argument('--endpoint-url')
+    s3_parser.add_argument('--bucket', default='transfer-check')
+    s3_parser.add_argument('--access-key', default='testing')
+    s3_parser.add_argument('--secret-key', default='testing')
+    s3_parser.add_argument('--size-mb', type=int, default=12, help='测试对象的大小，应大于分段大小')
+    s3_parser.add_argument('--part-mb', type=int, default=5, help='分段大小，S3 要求至少 5')
+    s3_parser.set_defaults(func=bench_s3)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# 分片的内存缓存: 键按哈希分到各分片，每个分片一把锁和一个按最近使用排序的 OrderedDict，
+# 多线程同时查询时很少互相等待。条目带过期时间，超出容量时淘汰最久没用的 (LRU)；
+# 值为 None 的条目记住 "不存在" (负缓存)，同一个无效的键不会反复查到后端
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class Shard:
+    def __init__(self, capacity):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.capacity = capacity
+
+
+class ShardedCache:
+    def __init__(self, capacity, ttl, negative_ttl, shards=16):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.shards = [Shard(max(1, -(-capacity // shards))) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key):
+        # 返回缓存的值 (负缓存为 None)；没有缓存或已过期时返回 MISSING
+        shard = self._shard(key)
+        now = time.monotonic()
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del shard.entries[key]
+                return MISSING
+            shard.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        # 返回因超出容量被淘汰的条目数
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        shard = self._shard(key)
+        with shard.lock:
+            shard.entries[key] = (time.monotonic() + ttl, value)
+            shard.entries.move_to_end(key)
+            evicted = 0
+            while len(shard.entries) > shard.capacity:
+                shard.entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def discard(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            shard.entries.pop(key, None)
@@ -0,0 +1,118 @@
+# 防暴力猜测: 按客户端统计一段时间内的失败次数，超过上限后封禁，再犯时封禁时间翻倍
+# 滑动窗口用 "上一窗口次数 x 尚未滑出的比例 + 本窗口次数" 近似，每个客户端只记几个数字；
+# 跟踪的客户端数有上限，超出时丢掉最久没有失败的
+import ipaddress
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+def subnet(ip, v4_prefix=24, v6_prefix=64):
+    # 同一网段的地址合并计数，换地址扫描也逃不掉；无法解析的地址按原样计数
+    # 常见的 IPv4 /24 直接截字符串，每个请求都要算，不走 ipaddress
+    if v4_prefix == 24 and ip.count('.') == 3 and ip.replace('.', '').isdigit():
+        return ip.rpartition('.')[0] + '.0/24'
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 6 and address.ipv4_mapped:
+        # 双栈监听时 IPv4 客户端的地址形如 ::ffff:1.2.3.4，按 IPv4 网段计数
+        address = address.ipv4_mapped
+    prefix = v4_prefix if address.version == 4 else v6_prefix
+    return str(ipaddress.ip_network((address, prefix), strict=False))
+
+
+class Client:
+    __slots__ = ('window', 'previous', 'current', 'blocked_until', 'strikes')
+
+    def __init__(self, now):
+        self.window = now
+        self.previous = 0
+        self.current = 0
+        self.blocked_until = 0
+        self.strikes = 0
+
+
+class FailureLimiter:
+    # window 秒内失败超过 limit 次时封禁 backoff 秒；封禁结束后 max_backoff 秒内再犯，封禁时间翻倍，最长 max_backoff 秒
+    def __init__(self, limit, window, backoff, max_backoff, capacity=100000):
+        self.limit = limit
+        self.window = window
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.clients = OrderedDict()
+
+    def blocked(self, key, now=None):
+        # 还要封禁的秒数，没有封禁时为 0；只读一次字典，被拒绝的请求几乎没有开销
+        client = self.clients.get(key)
+        if client is None:
+            return 0
+        now = time.monotonic() if now is None else now
+        return max(client.blocked_until - now, 0)
+
+    def failure(self, key, now=None):
+        # 记一次失败，返回因此开始的封禁秒数 (没有触发封禁时为 0)
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = self.clients[key] = Client(now)
+                if len(self.clients) > self.capacity:
+                    self.clients.popitem(last=False)
+            else:
+                self.clients.move_to_end(key)
+            elapsed = now - client.window
+            if elapsed >= self.window:
+                periods = int(elapsed // self.window)
+                client.previous = client.current if periods == 1 else 0
+                client.current = 0
+                client.window += periods * self.window
+            client.current += 1
+            rate = client.previous * (1 - (now - client.window) / self.window) + client.current
+            if rate <= self.limit or client.blocked_until > now:
+                return 0
+            if now - client.blocked_until > self.max_backoff:
+                client.strikes = 0
+            block = min(self.backoff * 2 ** client.strikes, self.max_backoff)
+            client.strikes += 1
+            client.blocked_until = now + block
+            return block
+
+
+class FailureLog:
+    # 失败和拒绝按时间段汇总成一行日志，扫描流量不会变成大量的磁盘写入
+    # 按来源计数的地址数有上限，超出的合并为 "其他"
+    def __init__(self, message, interval, max_sources=1000):
+        self.message = message
+        self.interval = interval
+        self.max_sources = max_sources
+        self.lock = threading.Lock()
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self.started = now
+        self.failures = 0
+        self.rejected = 0
+        self.sources = {}
+
+    def record(self, source, rejected=False):
+        now = time.monotonic()
+        with self.lock:
+            if rejected:
+                self.rejected += 1
+            else:
+                self.failures += 1
+            if source not in self.sources and len(self.sources) >= self.max_sources:
+                source = '其他'
+            self.sources[source] = self.sources.get(source, 0) + 1
+            if now - self.started < self.interval:
+                return
+            top = max(self.sources.items(), key=lambda item: item[1])
+            summary = (f'{self.message}: 失败 {self.failures} 次, 拒绝 {self.rejected} 次, '
+                       f'来自 {len(self.sources)} 个地址, 最多的是 {top[0]} ({top[1]} 次)')
+            self._reset(now)
+        logging.warning(summary)
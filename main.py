@@ -1,428 +1,2033 @@
-from flask import Flask, request, send_from_directory, render_template_string, session, jsonify, url_for, make_response
-from flask_wtf import FlaskForm
-from wtforms import FileField, SubmitField, StringField
-from wtforms.validators import DataRequired
-from werkzeug.utils import secure_filename, redirect
-from flask_cors import CORS
-import os
-import logging
-import shutil
-import random
-import string
-import zipfile
-
-app = Flask(__name__)
-CORS(app)
-app.config['SECRET_KEY'] = 'Best'
-app.config['UPLOAD_FOLDER'] = 'D:\\uploads'
-app.config['MAX_CONTENT_LENGTH'] = 8192 * 1024 * 1024
-
-file_links = {}
-
-def initialize_upload_folder():
-    if os.path.exists(app.config['UPLOAD_FOLDER']):
-        shutil.rmtree(app.config['UPLOAD_FOLDER'])
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-initialize_upload_folder()
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-class UploadForm(FlaskForm):
-    files = FileField(' ', validators=[DataRequired()])
-    submit = SubmitField('发送')
-
-class PickupCodeForm(FlaskForm):
-    pickup_code = StringField('取件码', validators=[DataRequired()])
-    submit = SubmitField('下载')
-
-def generate_unique_link():
-    characters = string.ascii_letters + string.digits
-    return ''.join(random.choice(characters) for _ in range(16))
-
-def generate_pickup_code():
-    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(4))
-
-upload_page = """
-<!doctype html>
-<html lang="zh">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>文件传输</title>
-    <style>
-        body {
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            min-height: 100vh;
-            margin: 0;
-            background-color: #f4f4f4;
-            font-family: Arial, sans-serif;
-        }
-        .container {
-            width: 90%;
-            max-width: 1200px;
-            background-color: white;
-            padding: 20px;
-            border-radius: 8px;
-            box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
-        }
-        .readme-box {
-            background-color: #e7f3ff;
-            border: 1px solid #b3d7ff;
-            border-radius: 5px;
-            padding: 15px;
-            color: #333;
-            margin-bottom: 20px;
-        }
-        .content {
-            display: flex;
-            flex-direction: column;
-            gap: 20px;
-        }
-        .left-column, .right-column {
-            padding: 20px;
-            border-radius: 5px;
-            background-color: #fff;
-            box-shadow: 0 2px 5px rgba(0, 0, 0, 0.1);
-        }
-        h1, h2 {
-            color: #333;
-        }
-        input[type=file], input[type=submit], input[type=text] {
-            padding: 10px;
-            margin-top: 10px;
-            width: 100%;
-            border: 1px solid #ccc;
-            border-radius: 5px;
-        }
-        input[type=text] {
-            width: auto; /* 调整取件码输入框的宽度 */
-        }
-        input[type=submit] {
-            background-color: #4caf50;
-            color: white;
-            border: none;
-            cursor: pointer;
-        }
-        input[type=submit]:hover {
-            background-color: #45a049;
-        }
-        .progress-container {
-            margin-top: 20px;
-            position: relative;
-            width: 100%;
-            height: 20px;
-            background-color: #f3f3f3;
-            border-radius: 10px;
-        }
-        .progress-bar {
-            position: absolute;
-            top: 0;
-            left: 0;
-            height: 100%;
-            background-color: #4caf50;
-            border-radius: 10px;
-            width: 0;
-            transition: width 0.4s;
-        }
-        .progress-text {
-            text-align: center;
-            position: absolute;
-            top: 50%;
-            left: 50%;
-            transform: translate(-50%, -50%);
-            color: #333;
-        }
-        .message {
-            margin-top: 10px;
-            color: #ff4500;
-        }
-        .error-message {
-            color: red;
-            margin-top: 20px;
-            display: none; /* 默认隐藏 */
-        }
-        ul {
-            list-style-type: none;
-            padding: 0;
-            margin: 0;
-        }
-        ul li {
-            background-color: #f9f9f9;
-            margin: 10px 0;
-            padding: 15px;
-            border-radius: 5px;
-            box-shadow: 0 2px 5px rgba(0, 0, 0, 0.1);
-            transition: background-color 0.3s;
-        }
-        ul li a {
-            text-decoration: none;
-            color: #007bff;
-            font-weight: bold;
-        }
-        ul li:hover {
-            background-color: #e7f1ff;
-        }
-        ul li a:hover {
-            color: #0056b3;
-        }
-        /* 新增样式以处理历史链接的滚动条 */
-        .history-list {
-            max-height: 300px; /* 设置最大高度 */
-            overflow-y: auto; /* 仅在需要时显示垂直滚动条 */
-            border: 1px solid #ccc;
-            border-radius: 5px;
-            padding: 10px; /* 内边距 */
-        }
-
-        /* 新增样式以处理下载链接 */
-        .download-link {
-            word-wrap: break-word; /* 允许长链接换行 */
-            overflow-wrap: break-word; /* 兼容性 */
-            max-width: 100%; /* 限制最大宽度 */
-            background-color: #f1f1f1;
-            padding: 10px;
-            border-radius: 5px;
-            margin-top: 10px;
-            word-break: break-all; /* 强制换行 */
-        }
-
-        @media (min-width: 768px) {
-            .content {
-                flex-direction: row;
-            }
-            .left-column, .right-column {
-                flex: 1;
-                margin: 0 10px;
-            }
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="readme-box">
-            <h2>ReadMe!</h2>
-            <p>欢迎使用文件传输工具！您可以通过选择单个或多个文件进行发送，系统会自动生成下载链接和取件码。</p>
-            <p>发送完成后，您可以在右侧查看历史记录和下载链接及取件码，仅保存本次浏览器历史记录。</p>
-            <p>请注意，因两个及以上文件程序会在发送后进行压缩，请尽量单个文件传输。</p>
-            <p>欢迎给与意见或建议 <a href="mailto:jiayu_zhou007@163.com">发送邮件</a></p>
-        </div>
-
-        <div class="content">
-            <div class="left-column">
-                <h2>发送文件</h2>
-                <form method="post" enctype="multipart/form-data" id="upload-form">
-                    {{ form.hidden_tag() }}
-                    {{ form.files.label() }}
-                    <input type="file" name="files" multiple required>
-                    <input type="submit" value="发送">
-                </form>
-                <div class="progress-container">
-                    <div class="progress-bar" id="progress-bar"></div>
-                    <div class="progress-text" id="progress-text">0%</div>
-                </div>
-                <p id="download-link" class="download-link"></p>
-                <p id="pickup-code"></p>
-                <p class="message" id="message"></p>
-                <p class="error-message" id="error-message">无效的取件码，请重新输入。</p>
-                
-                <h2>取件码下载文件</h2>
-                <form method="post" action="/download/pickup" id="pickup-form">
-                    <input type="text" name="pickup_code" placeholder="请输入取件码" required>
-                    <input type="submit" value="下载">
-                </form>
-            </div>
-            <div class="right-column">
-                <h2>历史链接记录</h2>
-                <div class="history-list">
-                    <ul>
-                        {% for item in history %}
-                            <li>
-                                <a href="{{ item.link }}">{{ item.filename }}</a> 
-                                (取件码: {{ item.pickup_code }})
-                            </li>
-                        {% endfor %}
-                    </ul>
-                </div>
-            </div>
-        </div>
-    </div>
-
-    <script>
-        document.addEventListener('DOMContentLoaded', function() {
-            const form = document.getElementById('upload-form');
-            const progressBar = document.getElementById('progress-bar');
-            const progressText = document.getElementById('progress-text');
-            const downloadLink = document.getElementById('download-link');
-            const pickupCode = document.getElementById('pickup-code');
-            const message = document.getElementById('message');
-            const errorMessage = document.getElementById('error-message');
-
-            form.onsubmit = function(event) {
-                event.preventDefault();
-                const formData = new FormData(form);
-                message.textContent = '文件发送中，请稍候...';
-
-                const xhr = new XMLHttpRequest();
-                xhr.open('POST', '/upload', true);
-
-                xhr.upload.onprogress = function(e) {
-                    if (e.lengthComputable) {
-                        const percent = Math.round((e.loaded / e.total) * 100);
-                        progressBar.style.width = percent + '%';
-                        progressText.textContent = percent + '%';
-                    }
-                };
-
-                xhr.onload = function() {
-                    if (xhr.status === 200) {
-                        const response = JSON.parse(xhr.responseText);
-                        if (response.success) {
-                            progressBar.style.width = '100%';
-                            progressText.textContent = '100%';
-                            downloadLink.innerHTML = '下载链接: <a href="' + response.download_link + '">' + response.download_link + '</a>';
-                            pickupCode.textContent = '取件码: ' + response.pickup_code;
-                            message.textContent = '文件发送成功！';
-                            setTimeout(function() {
-                                location.reload();
-                            }, 5000);
-                            // 调整页面刷新时间
-                        } else {
-                            message.textContent = '文件发送失败，请稍后再试';
-                        }
-                    } else {
-                        message.textContent = '文件发送失败，请稍后再试';
-                    }
-                };
-
-                xhr.onerror = function() {
-                    message.textContent = '文件发送失败，请稍后再试';
-                };
-
-                xhr.send(formData);
-            };
-
-            const pickupForm = document.getElementById('pickup-form');
-            pickupForm.onsubmit = function(event) {
-                event.preventDefault();
-                const pickupCodeValue = pickupForm.elements['pickup_code'].value;
-
-                // 发送取件码请求
-                fetch('/download/pickup', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: new URLSearchParams({ pickup_code: pickupCodeValue })
-                })
-                .then(response => {
-                    if (response.ok) {
-                        window.location.href = response.url; // 下载文件
-                    } else {
-                        errorMessage.style.display = 'block'; // 显示错误提示
-                    }
-                })
-                .catch(error => {
-                    console.error('错误:', error);
-                    errorMessage.style.display = 'block'; // 显示错误提示
-                });
-            };
-        });
-    </script>
-</body>
-</html>
-"""
-
-def set_no_cache_headers(response):
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
-
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    form = UploadForm()
-    history = session.get('history', [])
-    response = make_response(render_template_string(upload_page, form=form, history=history))
-    return set_no_cache_headers(response)
-
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    files = request.files.getlist('files')
-    unique_link = generate_unique_link()
-    pickup_code = generate_pickup_code()
-
-    try:
-        if not files:
-            return jsonify(success=False, message='没有文件被上传。')
-
-        for file in files:
-            if file:
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
-                file_links[unique_link] = file_links.get(unique_link, []) + [filename]
-
-        # Handle file zipping if multiple files uploaded
-        if len(files) > 1:
-            zip_filename = f"{unique_link}.zip"
-            zip_file_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
-
-            with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for filename in file_links[unique_link]:
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    zipf.write(file_path, arcname=filename)
-
-            download_link = url_for('download_zip', link=unique_link, _external=True)
-        else:
-            filename = file_links[unique_link][0]
-            download_link = url_for('download_file', filename=filename, _external=True)
-
-        # Store the link and pickup code in session history
-        session.setdefault('history', []).append({
-            'filename': zip_filename if len(files) > 1 else filename,
-            'link': download_link,
-            'pickup_code': pickup_code
-        })
-        session.modified = True
-
-        # Store the download link by pickup code
-        file_links[pickup_code] = download_link
-
-        return jsonify(success=True, download_link=download_link, pickup_code=pickup_code)
-    except Exception as e:
-        logging.error(f'文件发送失败: {e}')
-        return jsonify(success=False, message='文件发送失败，请稍后再试')
-
-@app.route('/download/pickup', methods=['POST'])
-def download_by_pickup_code():
-    pickup_code = request.form.get('pickup_code')
-    download_link = file_links.get(pickup_code)
-
-    if download_link:
-        return redirect(download_link)  # Redirect to the download link
-    else:
-        logging.error(f'无效的取件码: {pickup_code}')
-        return jsonify(success=False, message='无效的取件码。'), 404
-
-@app.route('/download/zip/<link>', methods=['GET'])
-def download_zip(link):
-    zip_filename = f"{link}.zip"
-    zip_file_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
-
-    if os.path.exists(zip_file_path):
-        return send_from_directory(app.config['UPLOAD_FOLDER'], zip_filename, as_attachment=True)
-    else:
-        logging.error(f'文件未找到: {zip_file_path}')
-        return '无效的下载链接。', 404
-
-@app.route('/download/file/<filename>', methods=['GET'])
-def download_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
-
-if __name__ == '__main__':
-    logging.info('服务器启动中...')
-    logging.info("当前版本v20241105,  ----By Jerry")
-    app.run(host='0.0.0.0', port=6789, debug=False)
\ No newline at end of file
+from flask import Flask, request, render_template, session, jsonify, url_for, make_response, Response
+from flask_wtf import FlaskForm
+from wtforms import FileField, SubmitField, StringField
+from wtforms.validators import DataRequired
+from werkzeug.utils import secure_filename, redirect
+from werkzeug.http import parse_range_header, parse_etags, parse_if_range_header, parse_date, http_date, quote_etag
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Data, Epilogue
+from flask_cors import CORS
+import argparse
+import gzip
+import os
+import hashlib
+import hmac
+import json
+import logging
+import mimetypes
+import re
+import shutil
+import secrets
+import sqlite3
+import string
+import ssl
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from cache import MISSING, ShardedCache
+from limiter import FailureLimiter, FailureLog, subnet
+from metrics import Registry
+from storage import create_storage
+from throttle import Shaper
+from zipstream import ZipStream
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+try:
+    import brotli
+except ImportError:  # 没有安装 brotli 时只提供 gzip
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，不过那里正在写入的文件本来就不能改名
+    fcntl = None
+
+app = Flask(__name__)
+CORS(app)
+app.config['SECRET_KEY'] = 'Best'
+app.config['UPLOAD_FOLDER'] = 'D:\\uploads'
+app.config['MAX_CONTENT_LENGTH'] = 8192 * 1024 * 1024
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024
+app.config['UPLOAD_PARALLEL'] = 4
+app.config['INGEST_BLOCK_SIZE'] = 4 * 1024 * 1024
+app.config['DOWNLOAD_BLOCK_SIZE'] = 1024 * 1024
+app.config['MAX_RANGES'] = 16
+# 打包下载时的压缩方式: store / deflate / bzip2，图片视频等已压缩的文件总是直接存储
+app.config['ZIP_CODEC'] = 'deflate'
+app.config['ZIP_LEVEL'] = 6
+app.config['ZIP_WORKERS'] = os.cpu_count() or 1
+
+# 启动时是否清空上传目录；默认保留已有数据，后台核对残留的临时文件
+app.config['WIPE_ON_START'] = False
+# 超过这个时间没有写入的临时文件才视为残留，避免误删正在上传的文件
+app.config['ORPHAN_GRACE'] = 3600
+
+# 过期清理: 链接默认有效期和发送方可选的最长有效期 (秒)，达到下载次数上限的链接保留 DOWNLOAD_GRACE 秒供续传
+app.config['TRANSFER_TTL'] = 7 * 24 * 3600
+app.config['MAX_TRANSFER_TTL'] = 30 * 24 * 3600
+app.config['DOWNLOAD_GRACE'] = 3600
+# 未完成的分块上传保留时间
+app.config['UPLOAD_SESSION_TTL'] = 24 * 3600
+# 秒传: 浏览器算好的摘要命中已存内容时，还要答出服务器随机挑的 DEDUP_PROOF_RANGES 段 (每段 DEDUP_PROOF_SIZE 字节)
+# 的摘要，证明手里确实有这个文件，才直接引用已存的内容；只知道摘要和大小不够
+app.config['DEDUP_PROOF_RANGES'] = 4
+app.config['DEDUP_PROOF_SIZE'] = 64 * 1024
+# 磁盘配额 (字节，0 为不限) 和需要保留的最小剩余空间；超出时按 EVICTION_POLICY 淘汰链接
+#   lru   最久没有访问的先删
+#   size  按 大小 x 闲置时间 从大到小删，优先腾出又大又冷的文件
+app.config['DISK_QUOTA'] = 0
+app.config['MIN_FREE_SPACE'] = 0
+app.config['EVICTION_POLICY'] = 'lru'
+# 后台清理每隔 REAPER_INTERVAL 秒执行一次，每轮最多删 REAPER_BATCH 个链接，每秒不超过 REAPER_RATE 个
+app.config['REAPER_INTERVAL'] = 60
+app.config['REAPER_BATCH'] = 500
+app.config['REAPER_RATE'] = 50
+
+# 生产环境服务: POSIX 上用 gunicorn 多进程 + 线程 (gthread)，Windows 上用 waitress 多线程
+#   SERVER_CONNECTIONS  每个进程同时处理的连接上限，超出的连接留在 SERVER_BACKLOG 里排队
+#   SERVER_GRACEFUL_TIMEOUT  重载或退出时等待进行中的传输完成的时间
+app.config['SERVER_WORKERS'] = (os.cpu_count() or 1) * 2
+app.config['SERVER_THREADS'] = 64
+app.config['SERVER_CONNECTIONS'] = 1000
+app.config['SERVER_BACKLOG'] = 2048
+app.config['SERVER_KEEPALIVE'] = 5
+app.config['SERVER_GRACEFUL_TIMEOUT'] = 300
+# 实际启动的工作进程数，由启动入口设置，用于在进程间平分全站限速
+app.config['SERVER_PROCESSES'] = 1
+# 下载限速 (字节/秒，0 为不限): 单个连接、单个 IP、单个链接和全站出口带宽
+# 全站带宽按权重在同时进行的下载之间公平分配，不超过 RATE_LIMIT_SMALL_SIZE 的文件权重为 RATE_LIMIT_SMALL_WEIGHT；
+# 每个下载开始时先可突发 RATE_LIMIT_BURST 字节，小文件基本不用排队。
+# 多进程时限速在各进程内分别计算，全站带宽按工作进程数平分
+app.config['RATE_LIMIT_CONNECTION'] = 0
+app.config['RATE_LIMIT_IP'] = 0
+app.config['RATE_LIMIT_TRANSFER'] = 0
+app.config['RATE_LIMIT_GLOBAL'] = 0
+app.config['RATE_LIMIT_BURST'] = 512 * 1024
+app.config['RATE_LIMIT_SMALL_SIZE'] = 8 * 1024 * 1024
+app.config['RATE_LIMIT_SMALL_WEIGHT'] = 4
+# 异步传输引擎 (asgi.py): 每个进程的连接上限、磁盘读写线程数、处理其他路由的线程数和每个连接的读写块大小
+app.config['ASYNC_CONNECTIONS'] = 10000
+app.config['ASYNC_DISK_THREADS'] = 32
+app.config['ASYNC_APP_THREADS'] = 16
+app.config['ASYNC_BLOCK_SIZE'] = 256 * 1024
+# 运行指标: /metrics 输出 Prometheus 文本格式；多进程时各进程每隔 METRICS_INTERVAL 秒写一次快照供汇总
+app.config['METRICS_INTERVAL'] = 10
+# 服务器端上传进度: 每个上传最多每 PROGRESS_INTERVAL 秒写一次进度，结束后的记录保留 PROGRESS_TTL 秒
+app.config['PROGRESS_INTERVAL'] = 1
+app.config['PROGRESS_TTL'] = 3600
+# 发送历史保存在服务器端，浏览器的 cookie 里只有会话编号；每页最多 HISTORY_PAGE_SIZE 条，保留 HISTORY_TTL 秒
+app.config['HISTORY_PAGE_SIZE'] = 20
+app.config['HISTORY_TTL'] = 30 * 24 * 3600
+# 取件码缓存: 每个进程最多缓存 PICKUP_CACHE_SIZE 个取件码，有效的保留 PICKUP_CACHE_TTL 秒 (不超过链接有效期)，
+# 无效的保留 PICKUP_CACHE_NEGATIVE_TTL 秒；其他进程新发的取件码最多要等这么久才能在本进程查到
+app.config['PICKUP_CACHE_SIZE'] = 100000
+app.config['PICKUP_CACHE_SHARDS'] = 16
+app.config['PICKUP_CACHE_TTL'] = 60
+app.config['PICKUP_CACHE_NEGATIVE_TTL'] = 5
+# 取件码至少 PICKUP_CODE_LENGTH 位，在用的取件码超过码空间的 PICKUP_CODE_OCCUPANCY 后自动加长一位，
+# 随便猜一个码猜中的概率始终不超过这个比例；后台保持 PICKUP_POOL_SIZE 个预先生成、确认未被占用的取件码
+app.config['PICKUP_CODE_LENGTH'] = 4
+app.config['PICKUP_CODE_OCCUPANCY'] = 0.001
+app.config['PICKUP_POOL_SIZE'] = 1000
+app.config['PICKUP_POOL_INTERVAL'] = 5
+# 取件码防猜测: 每个 IP 在 PICKUP_FAIL_WINDOW 秒内最多输错 PICKUP_FAIL_LIMIT 次，同一网段 (IPv4 /24、IPv6 /64)
+# 合计最多 PICKUP_SUBNET_FAIL_LIMIT 次；超过后封禁 PICKUP_BLOCK_SECONDS 秒，再犯时翻倍，最长 PICKUP_MAX_BLOCK_SECONDS 秒。
+# 每个进程最多跟踪 PICKUP_TRACKED_CLIENTS 个地址和网段，和其他限速一样在各进程内分别计数；
+# 输错和被拒绝的查询每 PICKUP_LOG_INTERVAL 秒汇总成一行日志
+app.config['PICKUP_FAIL_LIMIT'] = 10
+app.config['PICKUP_SUBNET_FAIL_LIMIT'] = 50
+app.config['PICKUP_FAIL_WINDOW'] = 60
+app.config['PICKUP_BLOCK_SECONDS'] = 30
+app.config['PICKUP_MAX_BLOCK_SECONDS'] = 3600
+app.config['PICKUP_TRACKED_CLIENTS'] = 100000
+app.config['PICKUP_LOG_INTERVAL'] = 60
+
+# blob 存储后端: local 保存在 UPLOAD_FOLDER/blobs；s3 保存在 S3 兼容的对象存储 (需要 pip install boto3)，
+# 用 MinIO 等自建服务时把 S3_ENDPOINT_URL 指向它。上传的暂存文件和未完成的分块始终在本地磁盘
+app.config['STORAGE_BACKEND'] = 'local'
+app.config['S3_BUCKET'] = ''
+app.config['S3_PREFIX'] = 'blobs/'
+app.config['S3_ENDPOINT_URL'] = None
+app.config['S3_REGION'] = None
+app.config['S3_ACCESS_KEY'] = None
+app.config['S3_SECRET_KEY'] = None
+app.config['S3_PART_SIZE'] = 8 * 1024 * 1024
+app.config['S3_CONNECTIONS'] = 64
+
+# 以上配置都可以用 TRANSFER_ 开头的环境变量覆盖，例如 TRANSFER_UPLOAD_FOLDER=/data/uploads
+app.config.from_prefixed_env('TRANSFER')
+app.config.setdefault('DATABASE', os.path.join(app.config['UPLOAD_FOLDER'], 'transfer.db'))
+
+storage = create_storage(app.config)
+
+registry = Registry()
+requests_total = registry.counter('transfer_http_requests_total', '请求数', ('route', 'method', 'status'))
+request_seconds = registry.histogram('transfer_http_request_duration_seconds', '从收到请求到响应发送完毕的时间', ('route',))
+ttfb_seconds = registry.histogram('transfer_http_ttfb_seconds', '从收到请求到发出第一个字节的时间', ('route',))
+bytes_received = registry.counter('transfer_bytes_received_total', '收到的上传数据字节数')
+bytes_sent = registry.counter('transfer_bytes_sent_total', '发出的响应字节数')
+save_seconds = registry.histogram('transfer_upload_save_seconds', '接收并保存上传文件的时间', ('stage',))
+zip_seconds = registry.histogram('transfer_zip_build_seconds', '生成打包下载所用的时间，不含等待客户端接收')
+active_transfers = registry.gauge('transfer_active', '进行中的上传和下载', ('direction',))
+pickup_lookups = registry.counter('transfer_pickup_lookups_total', '取件码查询: hit / miss / blocked', ('result',))
+pickup_blocks = registry.counter('transfer_pickup_blocks_total', '因输错取件码次数过多开始的封禁', ('scope',))
+pickup_cache_lookups = registry.counter('transfer_pickup_cache_total', '取件码缓存查询: hit / negative / miss', ('result',))
+pickup_cache_evictions = registry.counter('transfer_pickup_cache_evictions_total', '超出容量被淘汰的取件码缓存')
+
+pickup_cache = ShardedCache(app.config['PICKUP_CACHE_SIZE'], app.config['PICKUP_CACHE_TTL'],
+                            app.config['PICKUP_CACHE_NEGATIVE_TTL'], app.config['PICKUP_CACHE_SHARDS'])
+pickup_ip_limiter = FailureLimiter(app.config['PICKUP_FAIL_LIMIT'], app.config['PICKUP_FAIL_WINDOW'],
+                                   app.config['PICKUP_BLOCK_SECONDS'], app.config['PICKUP_MAX_BLOCK_SECONDS'],
+                                   app.config['PICKUP_TRACKED_CLIENTS'])
+pickup_subnet_limiter = FailureLimiter(app.config['PICKUP_SUBNET_FAIL_LIMIT'], app.config['PICKUP_FAIL_WINDOW'],
+                                       app.config['PICKUP_BLOCK_SECONDS'], app.config['PICKUP_MAX_BLOCK_SECONDS'],
+                                       app.config['PICKUP_TRACKED_CLIENTS'])
+pickup_failures = FailureLog('无效的取件码', app.config['PICKUP_LOG_INTERVAL'])
+
+# 元数据保存在 SQLite 中，多个工作进程共用:
+#   blobs         内容寻址存储，以 sha256 为键存在存储后端里，相同内容只保存一份，按引用计数回收
+#   transfers     每次发送生成的下载链接，带有效期、下载次数和最近访问时间
+#   files         每个链接下的文件，指向 blob；下载地址带链接编号，不同发送中的同名文件互不影响
+#   pickup_codes  取件码 -> 链接
+#   code_pool     预先生成的空闲取件码，按生成顺序取用
+#   uploads / upload_files  分块上传会话及各文件已收到的字节范围
+#   progress      上传在服务器端的处理进度，供 /progress 查询
+#   history       每个浏览器会话的发送历史
+schema = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS transfers (
+    link TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    expires REAL,
+    max_downloads INTEGER NOT NULL DEFAULT 0,
+    downloads INTEGER NOT NULL DEFAULT 0,
+    last_access REAL,
+    downloaded REAL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    link TEXT NOT NULL REFERENCES transfers(link) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    blob TEXT NOT NULL REFERENCES blobs(digest),
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_link ON files(link);
+CREATE TABLE IF NOT EXISTS pickup_codes (
+    code TEXT PRIMARY KEY,
+    link TEXT NOT NULL REFERENCES transfers(link) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pickup_codes_link ON pickup_codes(link);
+CREATE TABLE IF NOT EXISTS code_pool (
+    code TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    ttl REAL,
+    max_downloads INTEGER
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS upload_files (
+    upload_id TEXT NOT NULL REFERENCES uploads(upload_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    ranges TEXT NOT NULL,
+    blob TEXT,
+    challenge TEXT,
+    PRIMARY KEY (upload_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS progress (
+    id TEXT PRIMARY KEY,
+    phase TEXT NOT NULL,
+    done INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    result TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS progress_updated ON progress(updated);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    created REAL NOT NULL,
+    filename TEXT NOT NULL,
+    link TEXT NOT NULL,
+    pickup_code TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_session ON history(session, id);
+CREATE INDEX IF NOT EXISTS history_created ON history(created);
+"""
+
+# 旧版本数据库缺少的列，启动时补上，再建依赖这些列的索引
+migrations = [
+    ('transfers', 'expires', 'REAL'),
+    ('transfers', 'max_downloads', 'INTEGER NOT NULL DEFAULT 0'),
+    ('transfers', 'downloads', 'INTEGER NOT NULL DEFAULT 0'),
+    ('transfers', 'last_access', 'REAL'),
+    ('transfers', 'downloaded', 'REAL'),
+    ('uploads', 'ttl', 'REAL'),
+    ('uploads', 'max_downloads', 'INTEGER'),
+    ('upload_files', 'challenge', 'TEXT'),
+]
+
+indexes = """
+CREATE INDEX IF NOT EXISTS transfers_expires ON transfers(expires);
+CREATE INDEX IF NOT EXISTS transfers_last_access ON transfers(last_access);
+CREATE INDEX IF NOT EXISTS uploads_created ON uploads(created);
+DROP INDEX IF EXISTS files_name;
+"""
+
+db_local = threading.local()
+
+def get_db():
+    # 每个线程一个连接；sqlite3 会按连接缓存编译好的语句，相同 SQL 不会重复解析
+    conn = getattr(db_local, 'conn', None)
+    if conn is None or db_local.pid != os.getpid():
+        conn = sqlite3.connect(app.config['DATABASE'], timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        db_local.conn = conn
+        db_local.pid = os.getpid()
+    return conn
+
+def close_db():
+    # 关闭当前线程的连接，fork 之前调用，子进程不会继承打开的数据库文件
+    conn = getattr(db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        db_local.conn = None
+
+@contextmanager
+def db_write():
+    # 写事务一开始就拿写锁，多进程下读-改-写也不会交错
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+
+def acquire_lease(name, ttl):
+    # 多个工作进程中只让一个执行后台任务；持有者可续期
+    owner = str(os.getpid())
+    now = time.time()
+    with db_write() as db:
+        row = db.execute('SELECT owner, expires FROM leases WHERE name = ?', (name,)).fetchone()
+        if row and row['owner'] != owner and row['expires'] > now:
+            return False
+        db.execute('INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)', (name, owner, now + ttl))
+        return True
+
+def release_lease(name):
+    with db_write() as db:
+        db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, str(os.getpid())))
+
+def migrate_schema():
+    get_db().executescript(schema)
+    with db_write() as db:
+        for table, column, definition in migrations:
+            columns = [row['name'] for row in db.execute(f'PRAGMA table_info({table})')]
+            if column not in columns:
+                db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        db.execute('UPDATE transfers SET expires = created + ?, last_access = created WHERE expires IS NULL',
+                   (app.config['TRANSFER_TTL'],))
+    get_db().executescript(indexes)
+
+def remove_stale(path, now):
+    try:
+        if now - os.stat(path).st_mtime > app.config['ORPHAN_GRACE']:
+            os.remove(path)
+            return True
+    except OSError:
+        pass
+    return False
+
+def reconcile_storage():
+    # 启动后在后台核对磁盘和元数据: 清理残留的临时文件、中断的上传和丢失的 blob
+    # 同时启动的多个进程只有一个核对；租约很短并在核对中不断续期，结束时释放，
+    # 崩溃或重新部署后新进程不会因为旧租约跳过核对
+    lease = 60
+    if not acquire_lease('reconcile', lease):
+        return
+    renewed = time.monotonic()
+
+    def renew():
+        nonlocal renewed
+        if time.monotonic() - renewed > lease / 3:
+            acquire_lease('reconcile', lease)
+            renewed = time.monotonic()
+
+    folder = app.config['UPLOAD_FOLDER']
+    started = time.time()
+    db = get_db()
+    removed = 0
+    try:
+        parent = os.path.dirname(os.path.normpath(folder)) or '.'
+        prefix = os.path.basename(os.path.normpath(folder)) + '.trash-'
+        for entry in os.scandir(parent):
+            if entry.name.startswith(prefix):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        for entry in os.scandir(os.path.join(folder, '.incoming')):
+            renew()
+            removed += remove_stale(entry.path, started)
+
+        for entry in os.scandir(os.path.join(folder, '.partial')):
+            renew()
+            upload_id = entry.name.split('_')[0]
+            if db.execute('SELECT 1 FROM uploads WHERE upload_id = ?', (upload_id,)).fetchone() is None:
+                removed += remove_stale(entry.path, started)
+
+        # 分块文件已不存在的上传会话无法续传，直接删除
+        for row in db.execute('SELECT upload_id, position FROM upload_files WHERE blob IS NULL').fetchall():
+            renew()
+            if not os.path.exists(partial_path(row['upload_id'], row['position'])):
+                with db_write() as tx:
+                    tx.execute('DELETE FROM uploads WHERE upload_id = ? AND created < ?',
+                               (row['upload_id'], started - app.config['ORPHAN_GRACE']))
+
+        # 元数据中没有的 blob 文件是提交到一半中断留下的
+        stored = set()
+        for key, mtime in storage.scan():
+            renew()
+            if db.execute('SELECT 1 FROM blobs WHERE digest = ?', (key,)).fetchone() is not None:
+                stored.add(key)
+            elif started - mtime > app.config['ORPHAN_GRACE']:
+                storage.delete(key)
+                removed += 1
+
+        # 删到一半中断的 blob 补删
+        for row in db.execute('SELECT digest FROM blobs WHERE refs = 0').fetchall():
+            renew()
+            purge_blob(row['digest'])
+
+        # 文件已丢失的 blob，相关链接一并删除，下载时直接返回无效链接；列出之后才提交的 blob 再单独确认一次
+        for row in db.execute('SELECT digest FROM blobs WHERE refs > 0').fetchall():
+            renew()
+            if row['digest'] not in stored and storage.stat(row['digest']) is None:
+                logging.error(f'文件丢失: {row["digest"]}')
+                links = db.execute('SELECT DISTINCT link FROM files WHERE blob = ?', (row['digest'],)).fetchall()
+                for link in links:
+                    delete_transfer(link['link'])
+    except Exception as e:
+        logging.error(f'存储核对失败: {e}')
+        return
+    finally:
+        try:
+            release_lease('reconcile')
+        except sqlite3.Error as e:
+            logging.error(f'释放租约失败: {e}')
+    logging.info(f'存储核对完成: 清理 {removed} 个残留文件, 用时 {time.time() - started:.1f} 秒')
+
+def initialize_upload_folder():
+    folder = app.config['UPLOAD_FOLDER']
+    if app.config['WIPE_ON_START'] and os.path.exists(folder):
+        # 先改名再在后台删除，大目录也不会拖慢启动
+        trash = f'{os.path.normpath(folder)}.trash-{int(time.time())}'
+        os.replace(folder, trash)
+        threading.Thread(target=shutil.rmtree, args=(trash, True), daemon=True).start()
+    os.makedirs(folder, exist_ok=True)
+    os.makedirs(os.path.join(folder, '.partial'), exist_ok=True)
+    os.makedirs(os.path.join(folder, '.incoming'), exist_ok=True)
+    storage.prepare()
+    registry.share(os.path.join(folder, '.metrics'), app.config['METRICS_INTERVAL'])
+    migrate_schema()
+
+def start_background_tasks():
+    # 在真正处理请求的进程里启动；gunicorn 的主进程不能带着这些线程 fork，
+    # 子进程里它们不存在，而它们当时持有的锁会一直锁着
+    threading.Thread(target=reconcile_storage, name='reconcile', daemon=True).start()
+    threading.Thread(target=run_reaper, name='reaper', daemon=True).start()
+    threading.Thread(target=run_code_pool, name='codes', daemon=True).start()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class UploadForm(FlaskForm):
+    files = FileField(' ', validators=[DataRequired()])
+    submit = SubmitField('发送')
+
+class PickupCodeForm(FlaskForm):
+    pickup_code = StringField('取件码', validators=[DataRequired()])
+    submit = SubmitField('下载')
+
+CODE_CHARACTERS = string.ascii_letters + string.digits
+
+def generate_unique_link():
+    # 来自系统的密码学安全随机源，16 位约 95 比特，无法猜测也不会重复
+    return ''.join(secrets.choice(CODE_CHARACTERS) for _ in range(16))
+
+def generate_pickup_code(length):
+    return ''.join(secrets.choice(CODE_CHARACTERS) for _ in range(length))
+
+pickup_code_length = None
+pickup_code_checked = 0
+
+def current_code_length(db):
+    # 按在用和池中的取件码数量决定位数，每分钟最多统计一次；分配时遇到冲突会清掉缓存，下次重新统计
+    global pickup_code_length, pickup_code_checked
+    now = time.monotonic()
+    if pickup_code_length is None or now - pickup_code_checked > 60:
+        live = db.execute('SELECT (SELECT count(*) FROM pickup_codes) + (SELECT count(*) FROM code_pool)').fetchone()[0]
+        length = app.config['PICKUP_CODE_LENGTH']
+        while live > len(CODE_CHARACTERS) ** length * app.config['PICKUP_CODE_OCCUPANCY']:
+            length += 1
+        pickup_code_length, pickup_code_checked = length, now
+    return pickup_code_length
+
+def allocate_pickup_code(db, unique_link):
+    # 在调用方的写事务里分配: 先从池中取，池空了再现场生成；两种方式都和在用的及池中的取件码比对，不会重复
+    row = db.execute('DELETE FROM code_pool WHERE rowid = (SELECT min(rowid) FROM code_pool) RETURNING code').fetchone()
+    if row:
+        db.execute('INSERT INTO pickup_codes (code, link) VALUES (?, ?)', (row['code'], unique_link))
+        return row['code']
+    global pickup_code_length
+    length = current_code_length(db)
+    while True:
+        for _ in range(10):
+            code = generate_pickup_code(length)
+            if db.execute('INSERT OR IGNORE INTO pickup_codes (code, link) SELECT ?, ? '
+                          'WHERE NOT EXISTS (SELECT 1 FROM code_pool WHERE code = ?)',
+                          (code, unique_link, code)).rowcount:
+                return code
+            pickup_code_length = None
+        # 连续冲突说明这个位数快用满了: 重新统计，统计结果还是这么长就加一位
+        length = max(current_code_length(db), length + 1)
+
+def refill_code_pool():
+    # 位数变长后池中较短的码作废
+    with db_write() as db:
+        length = current_code_length(db)
+        db.execute('DELETE FROM code_pool WHERE length(code) < ?', (length,))
+        missing = app.config['PICKUP_POOL_SIZE'] - db.execute('SELECT count(*) FROM code_pool').fetchone()[0]
+        for _ in range(missing):
+            code = generate_pickup_code(length)
+            db.execute('INSERT OR IGNORE INTO code_pool (code) SELECT ? '
+                       'WHERE NOT EXISTS (SELECT 1 FROM pickup_codes WHERE code = ?)', (code, code))
+
+def run_code_pool():
+    # 多个工作进程中只有拿到租约的一个补充取件码池
+    while True:
+        try:
+            if acquire_lease('codes', app.config['PICKUP_POOL_INTERVAL'] * 3):
+                refill_code_pool()
+        except Exception as e:
+            logging.error(f'取件码预生成失败: {e}')
+        time.sleep(app.config['PICKUP_POOL_INTERVAL'])
+
+def partial_path(upload_id, index):
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.partial', f'{upload_id}_{index}')
+
+def preallocate(path, size):
+    # 只设置文件长度 (稀疏文件)，不预留磁盘块: 大小由客户端声明，预留的空间也不计入配额，
+    # 真正占用的只有已经收到的数据
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+def open_partial(upload_id, index):
+    # 写入期间对分块文件持有共享锁；拿到锁时文件已被收尾改名的话放弃写入，不会写进已经算过摘要的文件
+    path = partial_path(upload_id, index)
+    fd = os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            moved = not os.path.samestat(os.fstat(fd), os.stat(path))
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            os.close(fd)
+            raise FileNotFoundError(path)
+    return fd
+
+@contextmanager
+def settled(path):
+    # 等已经打开这个文件的分块写入全部结束，持有排他锁期间不会再有新的写入
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def write_at(fd, data, offset):
+    # 各分块并发写同一个文件，用定位写避免共享文件指针
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return round(rss / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+def incoming_path():
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.incoming', generate_unique_link())
+
+def hash_file(path, block_size, report=None):
+    # report 每读完一块收到已处理的字节数
+    digest = hashlib.sha256()
+    hashed = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            digest.update(data)
+            hashed += len(data)
+            if report:
+                report(hashed)
+    return digest.hexdigest()
+
+def commit_blob(temp_path, digest, size):
+    # 已有相同内容时丢弃新文件，否则存入存储后端；调用方获得一个引用。相同内容正在删除时先等删除完成
+    while True:
+        with db_write() as db:
+            row = db.execute('SELECT refs FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row and row['refs']:
+                db.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ?', (digest,))
+                os.remove(temp_path)
+                logging.info(f'重复内容已去重: {digest[:12]}')
+                return
+            if row is None and storage.is_local:
+                # 本地存储只是改名，在事务里完成
+                storage.put_file(digest, temp_path)
+                db.execute('INSERT INTO blobs (digest, size, refs) VALUES (?, ?, 1)', (digest, size))
+                return
+        if row is None:
+            break
+        wait_deleted(digest)
+
+    # 对象存储上传耗时长，不能占着写锁: 先上传再登记。上传期间相同内容可能刚被释放并删除，登记前确认对象还在
+    storage.put_file(digest, temp_path)
+    while True:
+        with db_write() as db:
+            row = db.execute('SELECT refs FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row and row['refs']:
+                db.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ?', (digest,))
+                return
+            if row is None:
+                if storage.stat(digest) is None:
+                    raise IOError(f'文件保存失败: {digest}')
+                db.execute('INSERT INTO blobs (digest, size, refs) VALUES (?, ?, 1)', (digest, size))
+                return
+        wait_deleted(digest)
+
+def acquire_blob(digest):
+    with db_write() as db:
+        return db.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ? AND refs > 0', (digest,)).rowcount > 0
+
+def find_blob(digest, size):
+    # 客户端声明的摘要和大小都与已存内容一致时才算命中
+    if not isinstance(digest, str) or not re.fullmatch('[0-9a-f]{64}', digest):
+        return None
+    row = get_db().execute('SELECT size FROM blobs WHERE digest = ? AND refs > 0', (digest,)).fetchone()
+    if row is None or row['size'] != size:
+        return None
+    return digest
+
+def possession_challenge(size):
+    # 随机挑几段内容和一个随机数，客户端要算出 sha256(随机数 + 这几段内容)；小文件直接用整个文件
+    count, length = app.config['DEDUP_PROOF_RANGES'], app.config['DEDUP_PROOF_SIZE']
+    if size <= count * length:
+        ranges = [[0, size]]
+    else:
+        ranges = [[start, start + length] for start in sorted(secrets.randbelow(size - length + 1) for _ in range(count))]
+    return {'nonce': secrets.token_hex(16), 'ranges': ranges}
+
+def possession_proof(digest, challenge):
+    proof = hashlib.sha256(bytes.fromhex(challenge['nonce']))
+    for start, end in challenge['ranges']:
+        for data in storage.get_range(digest, start, end, app.config['DOWNLOAD_BLOCK_SIZE']):
+            proof.update(data)
+    return proof.hexdigest()
+
+def decoy_challenge(challenge):
+    # 没有命中的挑战拿一个已存的文件读同样多的内容，回答用时和命中时一样，看不出内容是否已存在
+    ranges = [[0, end - start] for start, end in challenge['ranges']]
+    row = get_db().execute('SELECT digest FROM blobs WHERE size >= ? AND refs > 0 LIMIT 1',
+                           (max(end for _, end in ranges),)).fetchone()
+    return (row['digest'] if row else None), dict(challenge, ranges=ranges)
+
+def release_blob(digest, db=None):
+    # 引用数减一，归零时返回文件大小，否则返回 None。归零的记录留着 (refs = 0) 表示正在删除，
+    # 提交后再删文件，对象存储删除慢也不占着写锁；传入 db 时由调用方在提交后调用 purge_blob
+    if db is None:
+        with db_write() as db:
+            size = release_blob(digest, db)
+        if size is not None:
+            purge_blob(digest)
+        return size
+    row = db.execute('UPDATE blobs SET refs = refs - 1 WHERE digest = ? AND refs > 0 RETURNING refs, size',
+                     (digest,)).fetchone()
+    if row is None or row['refs'] > 0:
+        return None
+    return row['size']
+
+def purge_blob(digest):
+    # 删掉引用数已归零的文件，再去掉记录；删除失败时文件留给存储核对清理
+    try:
+        storage.delete(digest)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.error(f'删除文件失败: {digest}: {e}')
+    with db_write() as db:
+        db.execute('DELETE FROM blobs WHERE digest = ? AND refs = 0', (digest,))
+
+def wait_deleted(digest):
+    # 等正在删除的相同内容删完，免得刚存入的文件被删掉；删除方中途退出时超时后自己补删
+    deadline = time.monotonic() + 60
+    while get_db().execute('SELECT 1 FROM blobs WHERE digest = ? AND refs = 0', (digest,)).fetchone():
+        if time.monotonic() > deadline:
+            purge_blob(digest)
+            return
+        time.sleep(0.05)
+
+class BlockWriter:
+    # 攒满整块再写，每次写入都从块边界开始；同时计算内容摘要
+    def __init__(self, path, block_size):
+        self.path = path
+        self.file = open(path, 'wb', buffering=0)
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self._flush(len(self.buffer) - len(self.buffer) % self.block_size)
+
+    def _flush(self, length):
+        with memoryview(self.buffer) as view:
+            written = 0
+            while written < length:
+                written += self.file.write(view[written:length])
+        del self.buffer[:length]
+
+    def close(self):
+        self._flush(len(self.buffer))
+        self.file.close()
+
+class MultipartIngest:
+    # 边解析 multipart 边写入暂存文件并计算摘要，不经过 Werkzeug 的临时文件
+    # 每收到一段数据调用一次 feed，数据结束时 feed(None)；同步和异步两种接收方式共用
+    def __init__(self, boundary, block_size, progress=None):
+        self.decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self.block_size = block_size
+        self.progress = progress
+        self.files = []
+        self.received = 0
+        self.writer = None
+        self.filename = None
+        self.complete = False
+
+    def feed(self, data):
+        if data:
+            self.received += len(data)
+            if self.progress is not None:
+                self.progress.update(self.received)
+        self.decoder.receive_data(data or None)
+        while True:
+            event = self.decoder.next_event()
+            if isinstance(event, NeedData):
+                return
+            elif isinstance(event, File):
+                if event.name == 'files' and event.filename:
+                    self.filename = secure_filename(event.filename) or 'file'
+                    self.writer = BlockWriter(incoming_path(), self.block_size)
+            elif isinstance(event, Data):
+                if self.writer:
+                    self.writer.write(event.data)
+                    if not event.more_data:
+                        writer = self.writer
+                        self.writer = None
+                        writer.close()
+                        digest = writer.hash.hexdigest()
+                        commit_blob(writer.path, digest, writer.size)
+                        self.files.append({'name': self.filename, 'blob': digest, 'size': writer.size})
+            elif isinstance(event, Epilogue):
+                self.complete = True
+                return
+
+    def abort(self):
+        for entry in self.files:
+            release_blob(entry['blob'])
+        self.files = []
+        if self.writer:
+            self.writer.file.close()
+            os.remove(self.writer.path)
+            self.writer = None
+
+def ingest_multipart(stream, boundary, block_size, progress=None):
+    ingest = MultipartIngest(boundary, block_size, progress)
+    try:
+        while not ingest.complete:
+            ingest.feed(stream.read(block_size))
+    except Exception:
+        ingest.abort()
+        raise
+    return ingest.files, ingest.received
+
+def merge_range(ranges, start, end):
+    merged = []
+    for s, e in sorted(ranges + [[start, end]]):
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return merged
+
+def acknowledged_offset(ranges):
+    # 从文件开头起连续收到的字节数，客户端从这里续传
+    if ranges and ranges[0][0] == 0:
+        return ranges[0][1]
+    return 0
+
+def is_complete(entry):
+    return entry['size'] == 0 or entry['ranges'] == [[0, entry['size']]]
+
+def load_upload(upload_id, db=None):
+    db = db or get_db()
+    rows = db.execute('SELECT name, size, ranges, blob FROM upload_files WHERE upload_id = ? ORDER BY position',
+                      (upload_id,)).fetchall()
+    if not rows:
+        return None
+    files = []
+    for row in rows:
+        entry = {'filename': row['name'], 'size': row['size'], 'ranges': json.loads(row['ranges'])}
+        if row['blob']:
+            entry['blob'] = row['blob']
+        files.append(entry)
+    return {'files': files}
+
+def record_range(upload_id, index, start, end):
+    with db_write() as db:
+        row = db.execute('SELECT ranges FROM upload_files WHERE upload_id = ? AND position = ?',
+                         (upload_id, index)).fetchone()
+        if row is None:
+            # 写入期间会话已收尾或过期清理
+            return None
+        ranges = merge_range(json.loads(row['ranges']), start, end)
+        db.execute('UPDATE upload_files SET ranges = ? WHERE upload_id = ? AND position = ?',
+                   (json.dumps(ranges), upload_id, index))
+        return ranges
+
+def chunk_options(req):
+    # 分块请求的起点、长度和可选的 CRC32 校验值；Flask 的 request 和 werkzeug 的 Request 都可以传入
+    return (req.args.get('offset', type=int), req.content_length,
+            req.headers.get('X-Chunk-CRC32', type=lambda value: int(value, 16)))
+
+def open_chunk(upload_id, index, offset, length, expected_crc):
+    # 检查分块请求: 有效时返回 (ChunkIngest, None)，否则返回 (None, (响应内容, 状态码))
+    upload = load_upload(upload_id)
+    if not upload or index >= len(upload['files']):
+        return None, ({'success': False, 'message': '上传会话不存在。'}, 404)
+
+    entry = upload['files'][index]
+    if 'blob' in entry:
+        return None, ({'success': True, 'offset': entry['size'], 'ranges': entry['ranges']}, 200)
+    if offset is None or length is None or offset < 0 or offset + length > entry['size']:
+        return None, ({'success': False, 'message': '分块范围无效。'}, 416)
+    if expected_crc is not None and length > app.config['UPLOAD_CHUNK_SIZE']:
+        return None, ({'success': False, 'message': '分块过大。'}, 413)
+    try:
+        return ChunkIngest(upload_id, index, offset, length, expected_crc, entry['ranges']), None
+    except FileNotFoundError:
+        # 会话刚刚收尾，分块文件已被取走
+        return None, ({'success': False, 'message': '上传会话不存在。'}, 404)
+
+class ChunkIngest:
+    # 边收边把分块定位写入分块文件；带校验值的分块先收在内存里，校验通过才写入，坏数据不会覆盖已收到的内容
+    # 每收到一段数据调用一次 feed，结束或出错时调用 close 得到 (响应内容, 状态码)；同步和异步两种接收方式共用
+    def __init__(self, upload_id, index, offset, length, expected_crc, ranges):
+        self.upload_id = upload_id
+        self.index = index
+        self.offset = offset
+        self.length = length
+        self.expected_crc = expected_crc
+        self.ranges = ranges
+        self.buffer = bytearray() if expected_crc is not None else None
+        self.received = 0
+        self.written = 0
+        self.started = time.perf_counter()
+        self.fd = open_partial(upload_id, index)
+
+    def feed(self, data):
+        data = data[:self.length - self.received]
+        self.received += len(data)
+        if self.buffer is not None:
+            self.buffer += data
+        else:
+            write_at(self.fd, data, self.offset + self.written)
+            self.written += len(data)
+
+    def close(self):
+        error = None
+        try:
+            if self.buffer is not None:
+                if self.received != self.length:
+                    error = '分块数据不完整。'
+                elif zlib.crc32(self.buffer) != self.expected_crc:
+                    logging.error(f'分块校验失败: {self.upload_id}/{self.index} @ {self.offset}')
+                    error = '分块校验失败。'
+                else:
+                    write_at(self.fd, self.buffer, self.offset)
+                    self.written = self.length
+        finally:
+            os.close(self.fd)
+            # 连接中断时已写入的部分也记下来，续传时不必重发
+            if self.written:
+                self.ranges = record_range(self.upload_id, self.index, self.offset, self.offset + self.written)
+            bytes_received.inc(self.written)
+            save_seconds.observe(time.perf_counter() - self.started, ('chunk',))
+        if self.ranges is None:
+            return {'success': False, 'message': '上传会话不存在。'}, 404
+        if error is None and self.written != self.length:
+            error = '分块数据不完整。'
+        if error:
+            return {'success': False, 'message': error}, 400
+        return {'success': True, 'offset': acknowledged_offset(self.ranges), 'ranges': self.ranges}, 200
+
+class Progress:
+    # 一次上传在服务器端的进度: ingest 接收 -> hash 校验 -> bundle 入库并生成链接 -> done / failed
+    # 进度按 PROGRESS_INTERVAL 节流写入数据库，换阶段和结束时立即写入，任何工作进程都能查到；
+    # 没有进度编号时什么都不记录。分块上传的接收进度由已收到的范围算出，不经过这里
+    def __init__(self, progress_id, total, phase, db=None):
+        self.id = progress_id
+        self.total = total or 0
+        self.phase = phase
+        self.done = 0
+        self.saved = 0
+        self._save(db=db)
+
+    def update(self, done, phase=None):
+        self.done = done
+        if phase and phase != self.phase:
+            self.phase = phase
+            self._save()
+        elif time.monotonic() - self.saved >= app.config['PROGRESS_INTERVAL']:
+            self._save()
+
+    def finish(self):
+        # 任何人知道编号就能查询进度，链接和取件码只在上传请求的响应里返回
+        self.phase = 'done'
+        self.done = self.total or self.done
+        self._save()
+
+    def fail(self, message):
+        self.phase = 'failed'
+        self._save({'message': message})
+
+    def _save(self, result=None, db=None):
+        if self.id is None:
+            return
+        self.saved = time.monotonic()
+        try:
+            (db or get_db()).execute(
+                'INSERT OR REPLACE INTO progress (id, phase, done, total, updated, result) VALUES (?, ?, ?, ?, ?, ?)',
+                (self.id, self.phase, self.done, self.total, time.time(), json.dumps(result) if result else None))
+        except sqlite3.Error as e:
+            # 进度只是参考，写不进去不影响上传本身
+            logging.error(f'记录上传进度失败: {self.id}: {e}')
+
+def start_progress(progress_id, total):
+    # 整体上传 (/upload) 用 ?progress=<编号> 带上先从 POST /progress 领到的编号；
+    # 只认服务器发出且还没用过的编号，别人不能猜编号或覆盖其他上传的进度。编号无效时不记录
+    if progress_id:
+        try:
+            claimed = get_db().execute("UPDATE progress SET phase = 'ingest', total = ?, updated = ? "
+                                       "WHERE id = ? AND phase = 'pending'",
+                                       (total or 0, time.time(), progress_id)).rowcount
+        except sqlite3.Error as e:
+            logging.error(f'记录上传进度失败: {progress_id}: {e}')
+            claimed = 0
+        if not claimed:
+            progress_id = None
+    return Progress(progress_id, total, 'ingest')
+
+def read_progress(progress_id):
+    db = get_db()
+    row = db.execute('SELECT phase, done, total, result FROM progress WHERE id = ?', (progress_id,)).fetchone()
+    if row:
+        state = {'phase': row['phase'], 'done': row['done'], 'total': row['total']}
+        if row['result']:
+            state.update(json.loads(row['result']))
+        return state
+    upload = load_upload(progress_id, db)
+    if upload:
+        return {'phase': 'ingest',
+                'done': sum(end - start for entry in upload['files'] for start, end in entry['ranges']),
+                'total': sum(entry['size'] for entry in upload['files'])}
+    return None
+
+def upload_status(upload_id, upload):
+    return {
+        'upload_id': upload_id,
+        'files': [{
+            'filename': entry['filename'],
+            'size': entry['size'],
+            'ranges': entry['ranges'],
+            'offset': acknowledged_offset(entry['ranges']),
+            'exists': 'blob' in entry,
+            'challenge': entry.get('challenge'),
+        } for entry in upload['files']]
+    }
+
+upload_page = """
+<!doctype html>
+<html lang="zh">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>文件传输</title>
+    <link rel="stylesheet" href="{{ style_url }}">
+</head>
+<body data-progress="{{ progress_mode }}" data-progress-interval="{{ progress_interval }}">
+    <div class="container">
+        <div class="readme-box">
+            <h2>ReadMe!</h2>
+            <p>欢迎使用文件传输工具！您可以通过选择单个或多个文件进行发送，系统会自动生成下载链接和取件码。</p>
+            <p>发送完成后，您可以在右侧查看历史记录和下载链接及取件码，仅保存本次浏览器历史记录。</p>
+            <p>请注意，因两个及以上文件程序会在发送后进行压缩，请尽量单个文件传输。</p>
+            <p>欢迎给与意见或建议 <a href="mailto:jiayu_zhou007@163.com">发送邮件</a></p>
+        </div>
+
+        <div class="content">
+            <div class="left-column">
+                <h2>发送文件</h2>
+                <form method="post" enctype="multipart/form-data" id="upload-form">
+                    {{ form.hidden_tag() }}
+                    {{ form.files.label() }}
+                    <input type="file" name="files" multiple required>
+                    <select name="ttl">
+                        <option value="3600">1 小时</option>
+                        <option value="86400">1 天</option>
+                        <option value="604800" selected>7 天</option>
+                        <option value="2592000">30 天</option>
+                    </select>
+                    <select name="max_downloads">
+                        <option value="0" selected>不限次数</option>
+                        <option value="1">下载 1 次</option>
+                        <option value="5">下载 5 次</option>
+                        <option value="20">下载 20 次</option>
+                    </select>
+                    <input type="submit" value="发送">
+                </form>
+                <div class="progress-container">
+                    <div class="progress-bar" id="progress-bar"></div>
+                    <div class="progress-text" id="progress-text">0%</div>
+                </div>
+                <p id="download-link" class="download-link"></p>
+                <p id="pickup-code"></p>
+                <p class="message" id="message"></p>
+                <p class="error-message" id="error-message">无效的取件码，请重新输入。</p>
+                
+                <h2>取件码下载文件</h2>
+                <form method="post" action="/download/pickup" id="pickup-form">
+                    <input type="text" name="pickup_code" placeholder="请输入取件码" required>
+                    <input type="submit" value="下载">
+                </form>
+            </div>
+            <div class="right-column">
+                <h2>历史链接记录</h2>
+                <div class="history-list" id="history-list">
+                    <ul id="history-items"></ul>
+                </div>
+            </div>
+        </div>
+    </div>
+
+    <script src="{{ script_url }}"></script>
+</body>
+</html>
+"""
+
+class Asset:
+    # 页面的 CSS / JS (static/ 目录): 文件名带内容摘要，内容变了地址就变，浏览器可以一直缓存；
+    # 启动时读一次并压缩好，按 Accept-Encoding 直接返回
+    def __init__(self, name, mimetype):
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            data = f.read()
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        base, ext = name.rsplit('.', 1)
+        self.name = f'{base}.{self.digest}.{ext}'
+        self.mimetype = mimetype
+        self.encodings = {'gzip': gzip.compress(data, 9, mtime=0), 'identity': data}
+        if brotli is not None:
+            self.encodings = {'br': brotli.compress(data, quality=11), **self.encodings}
+
+page_style = Asset('page.css', 'text/css')
+page_script = Asset('page.js', 'text/javascript')
+assets = {asset.name: asset for asset in (page_style, page_script)}
+# 模板只在启动时编译一次
+page_template = app.jinja_env.from_string(upload_page)
+
+def set_no_cache_headers(response):
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    return response
+
+def evaluate_download(headers, size, etag, mtime):
+    # 根据条件请求和 Range 头决定响应: 返回 (状态码, [(start, stop), ...])
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        if parse_etags(if_none_match).contains_weak(etag):
+            return 304, []
+    else:
+        since = parse_date(headers.get('If-Modified-Since'))
+        if since and int(mtime) <= since.timestamp():
+            return 304, []
+
+    full = [(0, size)]
+    rng = parse_range_header(headers.get('Range'))
+    if rng is None or rng.units != 'bytes':
+        return 200, full
+
+    if_range = headers.get('If-Range')
+    if if_range:
+        condition = parse_if_range_header(if_range)
+        if condition.etag is not None and condition.etag != etag:
+            return 200, full
+        if condition.date is not None and int(mtime) > condition.date.timestamp():
+            return 200, full
+
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    if not ranges:
+        return 416, []
+
+    # 合并重叠或相邻的区间，区间过多时按整个文件返回
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > app.config['MAX_RANGES']:
+        return 200, full
+    return 206, merged
+
+shaper = None
+
+def get_shaper():
+    global shaper
+    if shaper is None:
+        shaper = Shaper(app.config['RATE_LIMIT_CONNECTION'], app.config['RATE_LIMIT_IP'],
+                        app.config['RATE_LIMIT_TRANSFER'],
+                        app.config['RATE_LIMIT_GLOBAL'] / app.config['SERVER_PROCESSES'],
+                        app.config['RATE_LIMIT_BURST'])
+    return shaper
+
+def open_stream(link, size=None):
+    # 开始一个限速的下载流；没有配置限速时返回 None
+    small = size is not None and size <= app.config['RATE_LIMIT_SMALL_SIZE']
+    stream = get_shaper().open(request.remote_addr, link, app.config['RATE_LIMIT_SMALL_WEIGHT'] if small else 1)
+    if stream is not None:
+        request.environ['transfer.stream'] = stream
+    return stream
+
+def paced(iterable, stream, environ):
+    # 同步服务器在这里按令牌桶等待；异步引擎 (asgi.py) 自己在事件循环里等待，这里只负责结束时释放
+    wait = not environ.get('transfer.async')
+    try:
+        for data in iterable:
+            if wait and data:
+                time.sleep(stream.reserve(len(data)))
+            yield data
+    finally:
+        stream.close()
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+def iter_file_range(path, start, stop, environ, stream=None):
+    block_size = app.config['DOWNLOAD_BLOCK_SIZE']
+    sock = environ.get('werkzeug.socket')
+    with open(path, 'rb') as f:
+        if sock is not None and hasattr(os, 'sendfile') and not isinstance(sock, ssl.SSLSocket):
+            # 开发服务器下先发出响应头，再由内核直接把文件送进 socket
+            yield b''
+            offset = start
+            while offset < stop:
+                if stream is not None:
+                    time.sleep(stream.reserve(min(block_size, stop - offset)))
+                sent = os.sendfile(sock.fileno(), f.fileno(), offset, min(block_size, stop - offset))
+                if not sent:
+                    break
+                offset += sent
+                bytes_sent.inc(sent)
+            return
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+def iter_blob_range(key, start, stop, environ, stream=None):
+    # 本地存储可以用 sendfile，对象存储按 Range 逐块读出
+    path = storage.local_path(key)
+    if path is not None:
+        return iter_file_range(path, start, stop, environ, stream)
+    return storage.get_range(key, start, stop, app.config['DOWNLOAD_BLOCK_SIZE'])
+
+def iter_multipart_ranges(key, ranges, parts, closing, environ):
+    for (start, stop), part_header in zip(ranges, parts):
+        yield part_header
+        yield from iter_blob_range(key, start, stop, environ)
+    yield closing
+
+def send_stored_file(key, download_name, link=None, admit=None):
+    # 内容以摘要为键，摘要本身就是强 ETag
+    # admit(counted, resumed) 在确定要发送哪些字节后检查链接并记录下载，返回 False 时不发送
+    try:
+        st = storage.stat(key)
+    except OSError as e:
+        logging.error(f'读取文件失败: {e}')
+        return None
+    if st is None:
+        return None
+
+    etag = key
+    path = storage.local_path(key)
+    status, ranges = evaluate_download(request.headers, st.st_size, etag, st.st_mtime)
+    # 发送内容的 GET 都算下载；从中间开始的分段可能是续传，由 admit 决定是否免计
+    counted = request.method == 'GET' and status in (200, 206)
+    resumed = counted and ranges[0][0] > 0
+    if admit is not None and not admit(counted, resumed):
+        return None
+    content_type = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    response = Response(status=status, direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['ETag'] = quote_etag(etag)
+    response.headers['Last-Modified'] = http_date(st.st_mtime)
+    response.headers['Cache-Control'] = 'no-cache'
+
+    if status == 304:
+        return response
+    if status == 416:
+        response.headers['Content-Range'] = f'bytes */{st.st_size}'
+        return response
+
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    environ = request.environ
+    stream = open_stream(link, sum(stop - start for start, stop in ranges))
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response.content_type = content_type
+        response.content_length = stop - start
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{st.st_size}'
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if stream is not None:
+            # 限速时逐块发送，不能交给 file_wrapper 一次发完
+            response.response = paced(iter_blob_range(key, start, stop, environ, stream), stream, environ)
+        elif file_wrapper is not None and path is not None:
+            # gunicorn 等服务器的 file_wrapper 会用 sendfile 发送，从当前位置发 Content-Length 字节
+            f = open(path, 'rb')
+            f.seek(start)
+            response.response = file_wrapper(f, app.config['DOWNLOAD_BLOCK_SIZE'])
+        else:
+            response.response = iter_blob_range(key, start, stop, environ)
+        return response
+
+    boundary = generate_unique_link()
+    parts = [(f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+              f'Content-Range: bytes {start}-{stop - 1}/{st.st_size}\r\n\r\n').encode('latin-1')
+             for start, stop in ranges]
+    closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    response.content_type = f'multipart/byteranges; boundary={boundary}'
+    response.content_length = sum(len(part) for part in parts) + sum(stop - start for start, stop in ranges) + len(closing)
+    response.response = iter_multipart_ranges(key, ranges, parts, closing, environ)
+    if stream is not None:
+        response.response = paced(response.response, stream, environ)
+    return response
+
+# 上传下载接口在请求期间计入进行中的传输
+TRANSFER_ENDPOINTS = {'upload_file': 'upload', 'upload_chunk': 'upload', 'download_transfer_file': 'download',
+                      'download_zip': 'download'}
+
+@app.before_request
+def track_request():
+    environ = request.environ
+    environ['transfer.route'] = request.url_rule.rule if request.url_rule else 'unmatched'
+    direction = TRANSFER_ENDPOINTS.get(request.endpoint)
+    if direction:
+        environ['transfer.direction'] = direction
+        active_transfers.inc(labels=(direction,))
+
+def finish_request(environ, started, status):
+    route = environ.get('transfer.route', 'unmatched')
+    requests_total.inc(labels=(route, environ['REQUEST_METHOD'], status))
+    request_seconds.observe(time.perf_counter() - started, (route,))
+    direction = environ.pop('transfer.direction', None)
+    if direction:
+        active_transfers.dec(labels=(direction,))
+
+class MeteredBody:
+    # 响应体发送完毕 (服务器调用 close) 时记录耗时和字节数
+    def __init__(self, body, environ, started, status):
+        self.body = body
+        self.environ = environ
+        self.started = started
+        self.status = status
+        self.closed = False
+
+    def __iter__(self):
+        route = self.environ.get('transfer.route', 'unmatched')
+        first = True
+        for data in self.body:
+            if first:
+                ttfb_seconds.observe(time.perf_counter() - self.started, (route,))
+                first = False
+            bytes_sent.inc(len(data))
+            yield data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            finish_request(self.environ, self.started, self.status[0] if self.status else '500')
+
+class MetricsMiddleware:
+    # gunicorn 的 file_wrapper 原样交回服务器走 sendfile，按 Content-Length 计数
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        registry.start()
+        started = time.perf_counter()
+        status = []
+
+        def record_start(code, headers, exc_info=None):
+            status[:] = [code.split(' ', 1)[0], headers]
+            return start_response(code, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, record_start)
+        except Exception:
+            finish_request(environ, started, '500')
+            raise
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            route = environ.get('transfer.route', 'unmatched')
+            ttfb_seconds.observe(time.perf_counter() - started, (route,))
+            bytes_sent.inc(int(dict((k.lower(), v) for k, v in status[1]).get('content-length', 0)))
+            finish_request(environ, started, status[0])
+            return body
+        return MeteredBody(body, environ, started, status)
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+def timed(iterable, histogram):
+    # 只累计生成数据本身的耗时，不含等待客户端接收的时间；中途断开的不计入
+    spent = 0
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            data = next(iterator)
+        except StopIteration:
+            break
+        spent += time.perf_counter() - started
+        yield data
+    histogram.observe(spent)
+
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    form = UploadForm()
+    # 上传进度在异步引擎下用事件流推送，同步服务器上由页面定时查询
+    response = make_response(render_template(page_template, form=form,
+                                             style_url=url_for('page_asset', name=page_style.name),
+                                             script_url=url_for('page_asset', name=page_script.name),
+                                             progress_mode='events' if request.environ.get('transfer.async') else 'poll',
+                                             progress_interval=int(app.config['PROGRESS_INTERVAL'] * 1000)))
+    return set_no_cache_headers(response)
+
+@app.route('/assets/<name>', methods=['GET'])
+def page_asset(name):
+    asset = assets.get(name)
+    if asset is None:
+        return '文件不存在。', 404
+    encoding = next(encoding for encoding in asset.encodings
+                    if encoding == 'identity' or request.accept_encodings[encoding])
+    response = Response(asset.encodings[encoding], mimetype=asset.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(f'{asset.digest}-{encoding}')
+    return response.make_conditional(request)
+
+def transfer_download_link(unique_link, filenames):
+    # 多个文件在下载时再打包成 zip
+    if len(filenames) > 1:
+        return url_for('download_zip', link=unique_link, _external=True)
+    return url_for('download_transfer_file', link=unique_link, filename=filenames[0], _external=True)
+
+def transfer_options(values):
+    # 发送方可以指定有效期 (秒) 和最多下载次数 (0 为不限)，有效期不超过 MAX_TRANSFER_TTL
+    try:
+        ttl = int(values.get('ttl') or app.config['TRANSFER_TTL'])
+        max_downloads = int(values.get('max_downloads') or 0)
+    except (TypeError, ValueError):
+        raise ValueError('有效期或下载次数无效。')
+    return min(max(ttl, 60), app.config['MAX_TRANSFER_TTL']), max(max_downloads, 0)
+
+def register_transfer(unique_link, files, ttl=None, max_downloads=0):
+    # files: [{'name', 'blob', 'size'}]，每个条目持有对应 blob 的一个引用
+    now = time.time()
+    with db_write() as db:
+        db.execute('INSERT INTO transfers (link, created, expires, max_downloads, last_access) VALUES (?, ?, ?, ?, ?)',
+                   (unique_link, now, now + (ttl or app.config['TRANSFER_TTL']), max_downloads or 0, now))
+        db.executemany('INSERT INTO files (link, name, blob, size) VALUES (?, ?, ?, ?)',
+                       [(unique_link, entry['name'], entry['blob'], entry['size']) for entry in files])
+        # Store the pickup code for the link
+        pickup_code = allocate_pickup_code(db, unique_link)
+    # 本进程可能缓存了这个取件码 "不存在"
+    pickup_cache.discard(pickup_code)
+
+    download_link = transfer_download_link(unique_link, [entry['name'] for entry in files])
+
+    # Store the link and pickup code in session history
+    session_id = history_session()
+    with db_write() as db:
+        db.execute('INSERT INTO history (session, created, filename, link, pickup_code) VALUES (?, ?, ?, ?, ?)',
+                   (session_id, now, f"{unique_link}.zip" if len(files) > 1 else files[0]['name'],
+                    download_link, pickup_code))
+
+    return download_link, pickup_code
+
+def history_session():
+    # cookie 里只保存会话编号；旧版本存在 cookie 里的历史记录第一次访问时搬到服务器端
+    session_id = session.get('history_id')
+    if session_id is None:
+        session_id = session['history_id'] = generate_unique_link()
+    old = session.pop('history', None)
+    if old:
+        now = time.time()
+        with db_write() as db:
+            db.executemany('INSERT INTO history (session, created, filename, link, pickup_code) VALUES (?, ?, ?, ?, ?)',
+                           [(session_id, now, item['filename'], item['link'], item['pickup_code']) for item in old])
+    return session_id
+
+@app.route('/history', methods=['GET'])
+def history_page():
+    # 从新到旧分页: before 为上一页最后一条的编号
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', app.config['HISTORY_PAGE_SIZE'], type=int), 1), 100)
+    rows = get_db().execute('SELECT id, filename, link, pickup_code FROM history WHERE session = ? AND id < ? '
+                            'ORDER BY id DESC LIMIT ?',
+                            (history_session(), before or sys.maxsize, limit + 1)).fetchall()
+    items = [{'filename': row['filename'], 'link': row['link'], 'pickup_code': row['pickup_code']}
+             for row in rows[:limit]]
+    return jsonify(success=True, items=items, next=rows[limit - 1]['id'] if len(rows) > limit else None)
+
+def delete_transfer(unique_link):
+    # 文件记录和取件码随链接一起删除，再释放各自的 blob 引用；返回实际腾出的字节数
+    with db_write() as db:
+        blobs = [row['blob'] for row in db.execute('SELECT blob FROM files WHERE link = ?', (unique_link,))]
+        codes = [row['code'] for row in db.execute('SELECT code FROM pickup_codes WHERE link = ?', (unique_link,))]
+        db.execute('DELETE FROM transfers WHERE link = ?', (unique_link,))
+        released = [(digest, release_blob(digest, db)) for digest in blobs]
+    for code in codes:
+        pickup_cache.discard(code)
+    freed = 0
+    for digest, size in released:
+        if size is not None:
+            purge_blob(digest)
+            freed += size
+    return freed
+
+def open_transfer(unique_link, counted, resumed=False):
+    # 下载前检查链接是否还有效并记录访问；counted 为真时计一次下载次数
+    # 续传 (resumed) 只在上次计数的下载之后 DOWNLOAD_GRACE 秒内免计，没有下载过的链接直接用 Range 取中间也要计数；
+    # 最后一次下载后链接也保留 DOWNLOAD_GRACE 秒，让正在进行的下载还能续传
+    now = time.time()
+    row = get_db().execute('SELECT expires, max_downloads, downloads, last_access, downloaded FROM transfers '
+                           'WHERE link = ?', (unique_link,)).fetchone()
+    if row is None or row['expires'] <= now:
+        return False
+    if resumed and row['downloads'] and now - (row['downloaded'] or 0) < app.config['DOWNLOAD_GRACE']:
+        counted = False
+    if not counted:
+        if now - row['last_access'] < 60:
+            return True
+        with db_write() as db:
+            db.execute('UPDATE transfers SET last_access = ? WHERE link = ?', (now, unique_link))
+        return True
+    with db_write() as db:
+        row = db.execute('UPDATE transfers SET downloads = downloads + 1, last_access = ?, downloaded = ? '
+                         'WHERE link = ? AND expires > ? AND (max_downloads = 0 OR downloads < max_downloads) '
+                         'RETURNING downloads, max_downloads', (now, now, unique_link, now)).fetchone()
+        if row is None:
+            return False
+        if row['max_downloads'] and row['downloads'] >= row['max_downloads']:
+            db.execute('UPDATE transfers SET expires = min(expires, ?) WHERE link = ?',
+                       (now + app.config['DOWNLOAD_GRACE'], unique_link))
+    return True
+
+def disk_overage():
+    # 超出配额或剩余空间不足的字节数
+    over = 0
+    if app.config['DISK_QUOTA']:
+        used = get_db().execute('SELECT total(size) FROM blobs').fetchone()[0]
+        over = used - app.config['DISK_QUOTA']
+    if app.config['MIN_FREE_SPACE']:
+        free = shutil.disk_usage(app.config['UPLOAD_FOLDER']).free
+        over = max(over, app.config['MIN_FREE_SPACE'] - free)
+    return over
+
+def eviction_candidates(limit):
+    db = get_db()
+    if app.config['EVICTION_POLICY'] == 'size':
+        return [row['link'] for row in db.execute(
+            'SELECT link FROM transfers AS t ORDER BY '
+            '(SELECT total(size) FROM files WHERE link = t.link) * (? - last_access) DESC LIMIT ?',
+            (time.time(), limit))]
+    return [row['link'] for row in db.execute('SELECT link FROM transfers ORDER BY last_access LIMIT ?', (limit,))]
+
+def reap():
+    # 每个链接单独一个短事务，删除之间按 REAPER_RATE 限速，不长时间占着写锁和磁盘
+    now = time.time()
+    db = get_db()
+    pause = 1 / app.config['REAPER_RATE']
+    budget = app.config['REAPER_BATCH']
+    expired = evicted = freed = 0
+
+    for row in db.execute('SELECT link FROM transfers WHERE expires <= ? ORDER BY expires LIMIT ?',
+                          (now, budget)).fetchall():
+        freed += delete_transfer(row['link'])
+        expired += 1
+        time.sleep(pause)
+
+    # 长时间没有进展的分块上传
+    for row in db.execute('SELECT upload_id FROM uploads WHERE created < ? LIMIT ?',
+                          (now - app.config['UPLOAD_SESSION_TTL'], budget)).fetchall():
+        upload_id = row['upload_id']
+        paths = [partial_path(upload_id, r['position'])
+                 for r in db.execute('SELECT position FROM upload_files WHERE upload_id = ?', (upload_id,))]
+        if any(os.path.exists(path) and now - os.path.getmtime(path) < app.config['ORPHAN_GRACE'] for path in paths):
+            continue
+        with db_write() as tx:
+            tx.execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        time.sleep(pause)
+
+    db.execute('DELETE FROM progress WHERE updated < ?', (now - app.config['PROGRESS_TTL'],))
+    db.execute('DELETE FROM history WHERE id IN (SELECT id FROM history WHERE created < ? LIMIT ?)',
+               (now - app.config['HISTORY_TTL'], budget * 100))
+
+    over = disk_overage()
+    while over > 0 and evicted < budget:
+        candidates = eviction_candidates(budget - evicted)
+        if not candidates:
+            break
+        for link in candidates:
+            released = delete_transfer(link)
+            freed += released
+            over -= released
+            evicted += 1
+            time.sleep(pause)
+            if over <= 0:
+                break
+
+    if expired or evicted:
+        logging.info(f'清理完成: 过期 {expired} 个, 超出配额淘汰 {evicted} 个, 腾出 {freed / 1024 / 1024:.1f} MB')
+
+def run_reaper():
+    # 多个工作进程中只有拿到租约的一个执行清理
+    while True:
+        time.sleep(app.config['REAPER_INTERVAL'])
+        try:
+            if acquire_lease('reaper', app.config['REAPER_INTERVAL'] * 3):
+                reap()
+        except Exception as e:
+            logging.error(f'清理失败: {e}')
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    boundary = request.mimetype_params.get('boundary')
+    unique_link = generate_unique_link()
+    progress = None
+
+    try:
+        if request.mimetype != 'multipart/form-data' or not boundary:
+            return jsonify(success=False, message='没有文件被上传。')
+        try:
+            ttl, max_downloads = transfer_options(request.args)
+        except ValueError as e:
+            return jsonify(success=False, message=str(e)), 400
+
+        # 异步传输引擎 (asgi.py) 已经收完请求体时直接取结果
+        progress = request.environ.get('transfer.progress')
+        ingested = request.environ.get('transfer.ingested')
+        if isinstance(ingested, Exception):
+            raise ingested
+        if ingested:
+            files, received, elapsed = ingested
+        else:
+            progress = start_progress(request.args.get('progress'), request.content_length)
+            started = time.monotonic()
+            files, received = ingest_multipart(request.stream, boundary, app.config['INGEST_BLOCK_SIZE'], progress)
+            elapsed = time.monotonic() - started
+        if not files:
+            progress.fail('没有文件被上传。')
+            return jsonify(success=False, message='没有文件被上传。')
+
+        elapsed = max(elapsed, 1e-6)
+        bytes_received.inc(received)
+        save_seconds.observe(elapsed, ('ingest',))
+        stats = {'bytes': received, 'bytes_per_sec': int(received / elapsed), 'peak_rss_mb': peak_rss_mb()}
+        logging.info(f'接收完成: {received} 字节, {received / elapsed / 1024 / 1024:.1f} MB/s, 峰值内存 {stats["peak_rss_mb"]} MB')
+
+        # 摘要在接收时已经算好，接下来只剩登记链接
+        progress.update(received, 'bundle')
+        try:
+            download_link, pickup_code = register_transfer(unique_link, files, ttl, max_downloads)
+        except Exception:
+            for entry in files:
+                release_blob(entry['blob'])
+            raise
+        progress.finish()
+        return jsonify(success=True, download_link=download_link, pickup_code=pickup_code, stats=stats)
+    except Exception as e:
+        logging.error(f'文件发送失败: {e}')
+        if progress is not None:
+            progress.fail('文件发送失败，请稍后再试')
+        return jsonify(success=False, message='文件发送失败，请稍后再试')
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    data = request.get_json(silent=True) or {}
+    try:
+        ttl, max_downloads = transfer_options(data)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    files = []
+    for entry in data.get('files') or []:
+        filename = secure_filename(str(entry.get('name', ''))) or 'file'
+        size = entry.get('size')
+        if not isinstance(size, int) or size < 0 or size > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify(success=False, message='文件信息无效。'), 400
+        file = {'filename': filename, 'size': size, 'ranges': []}
+        # 浏览器算好了摘要时发一个持有证明的挑战，答对了才算已收到 (见 upload_proof)；
+        # 不论摘要是否命中都发挑战，回复里看不出服务器上有没有这个内容
+        if entry.get('sha256'):
+            file['challenge'] = possession_challenge(size)
+            file['claim'] = find_blob(entry.get('sha256'), size)
+        files.append(file)
+
+    if not files:
+        return jsonify(success=False, message='没有文件被上传。'), 400
+    # 一次上传的总大小和整体上传一样不超过 MAX_CONTENT_LENGTH
+    if sum(entry['size'] for entry in files) > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify(success=False, message='文件总大小超出限制。'), 413
+
+    upload_id = generate_unique_link()
+    for index, entry in enumerate(files):
+        preallocate(partial_path(upload_id, index), entry['size'])
+
+    with db_write() as db:
+        db.execute('INSERT INTO uploads (upload_id, created, ttl, max_downloads) VALUES (?, ?, ?, ?)',
+                   (upload_id, time.time(), ttl, max_downloads))
+        db.executemany('INSERT INTO upload_files (upload_id, position, name, size, ranges, challenge) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       [(upload_id, index, entry['filename'], entry['size'], json.dumps(entry['ranges']),
+                         json.dumps(dict(entry['challenge'], blob=entry['claim'])) if 'challenge' in entry else None)
+                        for index, entry in enumerate(files)])
+    upload = {'files': files}
+    logging.info(f'分块上传开始: {upload_id}, {len(files)} 个文件, {sum(bool(entry.get("claim")) for entry in files)} 个可能已存在')
+    return jsonify(success=True, chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+                   parallel=app.config['UPLOAD_PARALLEL'], **upload_status(upload_id, upload))
+
+@app.route('/upload/<upload_id>/<int:index>/proof', methods=['POST'])
+def upload_proof(upload_id, index):
+    # 答对挑战的文件直接引用已存的相同内容，不用再发送；每个挑战只能回答一次，答错或没有命中时照常上传
+    proof = (request.get_json(silent=True) or {}).get('proof')
+    with db_write() as db:
+        row = db.execute('SELECT challenge, size FROM upload_files WHERE upload_id = ? AND position = ? '
+                         'AND challenge IS NOT NULL', (upload_id, index)).fetchone()
+        if row is not None:
+            db.execute('UPDATE upload_files SET challenge = NULL WHERE upload_id = ? AND position = ?',
+                       (upload_id, index))
+    if row is None:
+        return jsonify(success=False, message='没有待验证的文件。'), 404
+
+    challenge = json.loads(row['challenge'])
+    blob, expected = challenge['blob'], challenge
+    if blob is None:
+        blob, expected = decoy_challenge(challenge)
+    exists = False
+    if blob and isinstance(proof, str):
+        try:
+            matched = hmac.compare_digest(proof.encode(), possession_proof(blob, expected).encode())
+            exists = matched and challenge['blob'] is not None
+        except OSError as e:
+            logging.error(f'读取文件失败: {e}')
+    if exists:
+        with db_write() as db:
+            db.execute('UPDATE upload_files SET blob = ?, ranges = ? WHERE upload_id = ? AND position = ?',
+                       (challenge['blob'], json.dumps([[0, row['size']]] if row['size'] else []), upload_id, index))
+        try:
+            os.remove(partial_path(upload_id, index))
+        except OSError:
+            pass
+    return jsonify(success=True, exists=exists)
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def upload_progress(upload_id):
+    upload = load_upload(upload_id)
+    if not upload:
+        return jsonify(success=False, message='上传会话不存在。'), 404
+    return jsonify(success=True, **upload_status(upload_id, upload))
+
+@app.route('/upload/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    # 异步传输引擎 (asgi.py) 已经边收边写完时直接取结果
+    ingested = request.environ.get('transfer.ingested')
+    if isinstance(ingested, Exception):
+        raise ingested
+    if ingested:
+        body, status = ingested
+        return jsonify(body), status
+
+    chunk, rejected = open_chunk(upload_id, index, *chunk_options(request))
+    if rejected:
+        body, status = rejected
+        return jsonify(body), status
+    try:
+        if chunk.buffer is not None:
+            chunk.feed(request.stream.read(chunk.length))
+        else:
+            while chunk.received < chunk.length:
+                block = request.stream.read(min(1024 * 1024, chunk.length - chunk.received))
+                if not block:
+                    break
+                chunk.feed(block)
+    except BaseException:
+        chunk.close()
+        raise
+    body, status = chunk.close()
+    return jsonify(body), status
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    with db_write() as db:
+        upload = load_upload(upload_id, db)
+        if not upload:
+            return jsonify(success=False, message='上传会话不存在。'), 404
+        missing = [index for index, entry in enumerate(upload['files']) if not is_complete(entry)]
+        if missing:
+            return jsonify(success=False, message='文件尚未接收完整。', missing=missing), 409
+        # 分块文件先改名到私有位置: 之后打开的分块请求找不到它，之前打开的在计算摘要前等它写完
+        moved = {}
+        try:
+            for index, entry in enumerate(upload['files']):
+                if 'blob' not in entry:
+                    moved[index] = incoming_path()
+                    os.replace(partial_path(upload_id, index), moved[index])
+        except OSError as e:
+            moved.popitem()
+            for index, temp in moved.items():
+                os.replace(temp, partial_path(upload_id, index))
+            if isinstance(e, PermissionError):
+                # Windows 上分块还在写入时不能改名，放回原处让客户端稍后再试
+                return jsonify(success=False, message='文件仍在写入，请稍后再试。'), 409
+            raise
+        options = db.execute('DELETE FROM uploads WHERE upload_id = ? RETURNING ttl, max_downloads',
+                             (upload_id,)).fetchone()
+        # 会话删除的同时写入进度，查询方不会看到两者都不存在的间隙
+        progress = Progress(upload_id, sum(entry['size'] for entry in upload['files']), 'hash', db)
+
+    files = []
+    hashed = 0
+    started = time.perf_counter()
+    try:
+        for index, entry in enumerate(upload['files']):
+            if 'blob' in entry:
+                if not acquire_blob(entry['blob']):
+                    raise IOError(f'文件已被删除: {entry["filename"]}')
+                files.append({'name': entry['filename'], 'blob': entry['blob'], 'size': entry['size']})
+                hashed += entry['size']
+                continue
+            path = moved[index]
+            with settled(path):
+                if os.path.getsize(path) != entry['size']:
+                    raise IOError(f'文件大小不符: {entry["filename"]}')
+                digest = hash_file(path, app.config['INGEST_BLOCK_SIZE'], lambda n: progress.update(hashed + n))
+                commit_blob(path, digest, entry['size'])
+            files.append({'name': entry['filename'], 'blob': digest, 'size': entry['size']})
+            hashed += entry['size']
+
+        save_seconds.observe(time.perf_counter() - started, ('finalize',))
+        progress.update(hashed, 'bundle')
+        download_link, pickup_code = register_transfer(generate_unique_link(), files, options['ttl'],
+                                                       options['max_downloads'])
+        progress.finish()
+        logging.info(f'分块上传完成: {upload_id}')
+        return jsonify(success=True, download_link=download_link, pickup_code=pickup_code)
+    except Exception as e:
+        for entry in files:
+            release_blob(entry['blob'])
+        # 已经提交的暂存文件不在原处了，其余的删掉
+        for path in moved.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logging.error(f'文件发送失败: {e}')
+        progress.fail('文件发送失败，请稍后再试')
+        return jsonify(success=False, message='文件发送失败，请稍后再试')
+
+class ProgressTicker:
+    # SSE 的轮询节奏: 异步引擎在发送每条消息前按 reserve 返回的秒数在事件循环里等待，不占线程；
+    # 同步服务器没有这一步，由生成器自己 sleep
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = False
+
+    def reserve(self, size):
+        if not self.started:
+            self.started = True
+            return 0
+        return self.interval
+
+def progress_events(progress_id, state, environ):
+    # 进度有变化时发一条事件，否则发一行注释保持连接；上传结束或记录被清理后关闭
+    interval = app.config['PROGRESS_INTERVAL']
+    last = None
+    while True:
+        if state != last:
+            yield f'data: {json.dumps(state)}\n\n'.encode()
+            last = state
+        else:
+            yield b':\n\n'
+        if state is None or state['phase'] in ('done', 'failed'):
+            return
+        if not environ.get('transfer.async'):
+            time.sleep(interval)
+        state = read_progress(progress_id)
+
+@app.route('/progress', methods=['POST'])
+def progress_create():
+    # 整体上传前先领一个进度编号 (pending)，上传时用 /upload?progress=<编号> 带上
+    progress_id = generate_unique_link()
+    get_db().execute("INSERT INTO progress (id, phase, done, total, updated) VALUES (?, 'pending', 0, 0, ?)",
+                     (progress_id, time.time()))
+    return jsonify(success=True, progress_id=progress_id)
+
+@app.route('/progress/<progress_id>', methods=['GET'])
+def progress_status(progress_id):
+    state = read_progress(progress_id)
+    if state is None:
+        return jsonify(success=False, message='没有这个上传的进度。'), 404
+    return jsonify(success=True, progress_id=progress_id, **state)
+
+@app.route('/progress/<progress_id>/events', methods=['GET'])
+def progress_stream(progress_id):
+    state = read_progress(progress_id)
+    if state is None:
+        return jsonify(success=False, message='没有这个上传的进度。'), 404
+    request.environ['transfer.stream'] = ProgressTicker(app.config['PROGRESS_INTERVAL'])
+    response = Response(progress_events(progress_id, state, request.environ), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 让 nginx 等反向代理不要缓冲事件流
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def lookup_pickup_code(pickup_code):
+    # 返回 ((链接, 文件名), 缓存秒数)；取件码无效时为 (None, None)。缓存不超过链接的有效期
+    db = get_db()
+    now = time.time()
+    row = db.execute('SELECT p.link, t.expires FROM pickup_codes AS p JOIN transfers AS t ON t.link = p.link '
+                     'WHERE p.code = ? AND t.expires > ?', (pickup_code, now)).fetchone()
+    filenames = [r['name'] for r in db.execute('SELECT name FROM files WHERE link = ? ORDER BY id LIMIT 2',
+                                                (row['link'],))] if row else []
+    if not filenames:
+        return None, None
+    return (row['link'], filenames), min(app.config['PICKUP_CACHE_TTL'], row['expires'] - now)
+
+@app.route('/download/pickup', methods=['POST'])
+def download_by_pickup_code():
+    # 先查封禁，被封禁的请求不解析表单、不查缓存和数据库，也不单独写日志
+    ip = request.remote_addr or ''
+    network = subnet(ip)
+    now = time.monotonic()
+    wait = max(pickup_ip_limiter.blocked(ip, now), pickup_subnet_limiter.blocked(network, now))
+    if wait:
+        pickup_lookups.inc(labels=('blocked',))
+        pickup_failures.record(ip, rejected=True)
+        return (jsonify(success=False, message='尝试次数过多，请稍后再试。'), 429,
+                {'Retry-After': str(int(wait) + 1)})
+
+    pickup_code = request.form.get('pickup_code') or ''
+    target = pickup_cache.get(pickup_code)
+    if target is MISSING:
+        pickup_cache_lookups.inc(labels=('miss',))
+        target, ttl = lookup_pickup_code(pickup_code)
+        pickup_cache_evictions.inc(pickup_cache.put(pickup_code, target, ttl))
+    else:
+        pickup_cache_lookups.inc(labels=('negative' if target is None else 'hit',))
+
+    pickup_lookups.inc(labels=('hit' if target else 'miss',))
+    if target:
+        download_link = transfer_download_link(*target)
+        # 页面用 fetch 查询时只返回链接，由浏览器直接打开；跟着重定向取一次会白白用掉一次下载次数
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(success=True, download_link=download_link)
+        return redirect(download_link)  # Redirect to the download link
+    else:
+        # 只有输错才计数，正常取件不受影响
+        if pickup_ip_limiter.failure(ip, now):
+            pickup_blocks.inc(labels=('ip',))
+        if pickup_subnet_limiter.failure(network, now):
+            pickup_blocks.inc(labels=('subnet',))
+        pickup_failures.record(ip)
+        return jsonify(success=False, message='无效的取件码。'), 404
+
+@app.route('/download/zip/<link>', methods=['GET'])
+def download_zip(link):
+    files = get_db().execute('SELECT name, blob FROM files WHERE link = ? ORDER BY id', (link,)).fetchall()
+    if not files or not open_transfer(link, request.method == 'GET'):
+        logging.error(f'文件未找到: {link}.zip')
+        return '无效的下载链接。', 404
+
+    entries = [(entry['blob'], entry['name']) for entry in files]
+    stream = ZipStream(entries, codec=app.config['ZIP_CODEC'], level=app.config['ZIP_LEVEL'],
+                       block_size=app.config['DOWNLOAD_BLOCK_SIZE'], workers=app.config['ZIP_WORKERS'],
+                       storage=storage)
+    body = timed(stream, zip_seconds)
+    shaped = open_stream(link)
+    response = Response(paced(body, shaped, request.environ) if shaped else body, mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f'{link}.zip')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/download/file/<link>/<filename>', methods=['GET'])
+def download_transfer_file(link, filename):
+    row = get_db().execute('SELECT blob FROM files WHERE link = ? AND name = ? ORDER BY id LIMIT 1',
+                           (link, filename)).fetchone()
+    response = None
+    if row:
+        response = send_stored_file(row['blob'], filename, link=link,
+                                    admit=lambda counted, resumed: open_transfer(link, counted, resumed))
+    if response is None:
+        return '无效的下载链接。', 404
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+initialize_upload_folder()
+# 作为模块导入时 (asgi.py、gunicorn main:app 等) 所在进程就是处理请求的进程；直接运行时由启动入口决定
+if __name__ != '__main__':
+    start_background_tasks()
+
+def serve_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    # 工作进程由主进程 fork 出来，直接沿用已初始化好的 app；
+    # fork 前主进程关闭自己的数据库连接，后台线程在每个工作进程 fork 之后才启动
+    # kill -HUP 平滑重启工作进程，kill -USR2 后再对旧主进程发 QUIT 可以不停机升级代码
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('when_ready', lambda server: close_db())
+            self.cfg.set('post_fork', lambda server, worker: start_background_tasks())
+            self.cfg.set('bind', f'{args.host}:{args.port}')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_connections', app.config['SERVER_CONNECTIONS'])
+            self.cfg.set('backlog', app.config['SERVER_BACKLOG'])
+            self.cfg.set('keepalive', app.config['SERVER_KEEPALIVE'])
+            self.cfg.set('graceful_timeout', app.config['SERVER_GRACEFUL_TIMEOUT'])
+
+        def load(self):
+            return app
+
+    app.config['SERVER_PROCESSES'] = args.workers
+    Server().run()
+
+def serve_waitress(args):
+    import waitress
+    # waitress 只有单进程，并发由线程数和连接上限控制
+    waitress.serve(app, host=args.host, port=args.port, threads=args.threads,
+                   connection_limit=app.config['SERVER_CONNECTIONS'], backlog=app.config['SERVER_BACKLOG'],
+                   channel_timeout=app.config['SERVER_KEEPALIVE'] * 24, ident='transfer')
+
+def default_server():
+    for name in (('waitress',) if os.name == 'nt' else ('gunicorn', 'waitress')):
+        try:
+            __import__(name)
+            return name
+        except ImportError:
+            continue
+    return 'dev'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='文件传输服务')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=6789)
+    parser.add_argument('--server', choices=['gunicorn', 'waitress', 'dev'], default=default_server(),
+                        help='dev 为 Flask 自带的开发服务器，仅用于调试')
+    parser.add_argument('--workers', type=int, default=app.config['SERVER_WORKERS'])
+    parser.add_argument('--threads', type=int, default=app.config['SERVER_THREADS'])
+    args = parser.parse_args()
+
+    logging.info('服务器启动中...')
+    logging.info("当前版本v20241105,  ----By Jerry")
+    if args.server == 'gunicorn':
+        serve_gunicorn(args)
+    elif args.server == 'waitress':
+        start_background_tasks()
+        serve_waitress(args)
+    else:
+        logging.warning('未安装 gunicorn / waitress，使用开发服务器')
+        start_background_tasks()
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
\ No newline at end of file
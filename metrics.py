@@ -0,0 +1,204 @@
+# Prometheus 文本格式的运行指标，不依赖 prometheus_client
+# 多进程时每个进程定期把自己的数值写到 directory/<pid>.json，/metrics 汇总各进程的数值
+import bisect
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dump(self):
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def absorb(self, key, value):
+        # 接手已退出进程的累计值
+        with self.lock:
+            self.values[key] = self.merge(self.values[key], value) if key in self.values else value
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{format_labels(self.labels, key)} {value}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def absorb(self, key, value):
+        # 仪表只反映当前状态，已退出进程的值直接丢弃
+        pass
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        # 每个值记在对应的区间里 (非累计)，最后两项为总和与次数
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def dump(self):
+        with self.lock:
+            return [[list(key), list(value)] for key, value in self.values.items()]
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def render(self, values):
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{format_labels(self.labels, key, [le])} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, key)} {counts[-2]}'
+            yield f'{self.name}_count{format_labels(self.labels, key)} {counts[-1]}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self.interval = 10
+        self.pid = None
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def share(self, directory, interval):
+        # 开启多进程汇总；写快照的线程在每个进程第一次调用 start 时启动
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+
+    def start(self):
+        if self.directory and self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name='metrics', daemon=True).start()
+
+    def snapshot(self):
+        return {metric.name: metric.dump() for metric in self.metrics}
+
+    def _flush(self):
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self._flush()
+
+    def _retire(self, path):
+        # 已退出进程的计数器和直方图并入本进程继续累计，汇总值不会因为工作进程重启而变小；
+        # 先改名认领，几个进程同时发现时只有一个接手
+        claimed = f'{path}.{os.getpid()}.retired'
+        try:
+            os.replace(path, claimed)
+        except OSError:
+            return
+        try:
+            with open(claimed) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            snapshot = {}
+        finally:
+            os.remove(claimed)
+        for metric in self.metrics:
+            for key, value in snapshot.get(metric.name, []):
+                metric.absorb(tuple(key), value)
+        if self.pid == os.getpid():
+            self._flush()
+
+    def _collect(self):
+        # 本进程用实时数值，其他进程读快照；长时间没有更新的快照属于已退出的进程，由本进程接手
+        snapshots = []
+        if self.directory:
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.json') or entry.name == f'{os.getpid()}.json':
+                    continue
+                try:
+                    if now - entry.stat().st_mtime > self.interval * 3:
+                        self._retire(entry.path)
+                        continue
+                    with open(entry.path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        # 接手之后再取本进程的数值
+        snapshots.append(self.snapshot())
+        merged = {}
+        for metric in self.metrics:
+            values = merged[metric.name] = {}
+            for snapshot in snapshots:
+                for key, value in snapshot.get(metric.name, []):
+                    key = tuple(key)
+                    values[key] = metric.merge(values[key], value) if key in values else value
+        return merged
+
+    def render(self):
+        merged = self._collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render(merged[metric.name]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,471 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const form = document.getElementById('upload-form');
+    const progressBar = document.getElementById('progress-bar');
+    const progressText = document.getElementById('progress-text');
+    const downloadLink = document.getElementById('download-link');
+    const pickupCode = document.getElementById('pickup-code');
+    const message = document.getElementById('message');
+    const errorMessage = document.getElementById('error-message');
+    const historyList = document.getElementById('history-list');
+    const historyItems = document.getElementById('history-items');
+
+    function showProgress(percent) {
+        progressBar.style.width = percent + '%';
+        progressText.textContent = percent + '%';
+    }
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    // 在 Worker 中分块计算 SHA-256（局域网 http 下没有 crypto.subtle，且它不支持分块计算）
+    const hashWorkerSource = `
+        const K = new Uint32Array([
+            0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+            0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+            0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+            0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+            0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+            0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+            0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+            0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+        ]);
+
+        function sha256() {
+            const H = new Uint32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+            const W = new Uint32Array(64);
+            const block = new Uint8Array(64);
+            let blockLength = 0;
+            let total = 0;
+
+            function compress(bytes, offset) {
+                for (let i = 0; i < 16; i++) {
+                    const j = offset + i * 4;
+                    W[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+                }
+                for (let i = 16; i < 64; i++) {
+                    const w15 = W[i - 15], w2 = W[i - 2];
+                    const s0 = ((w15 >>> 7) | (w15 << 25)) ^ ((w15 >>> 18) | (w15 << 14)) ^ (w15 >>> 3);
+                    const s1 = ((w2 >>> 17) | (w2 << 15)) ^ ((w2 >>> 19) | (w2 << 13)) ^ (w2 >>> 10);
+                    W[i] = W[i - 16] + s0 + W[i - 7] + s1;
+                }
+                let a = H[0], b = H[1], c = H[2], d = H[3], e = H[4], f = H[5], g = H[6], h = H[7];
+                for (let i = 0; i < 64; i++) {
+                    const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+                    const t1 = (h + S1 + ((e & f) ^ (~e & g)) + K[i] + W[i]) | 0;
+                    const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+                    const t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+                    h = g; g = f; f = e; e = (d + t1) | 0;
+                    d = c; c = b; b = a; a = (t1 + t2) | 0;
+                }
+                H[0] += a; H[1] += b; H[2] += c; H[3] += d;
+                H[4] += e; H[5] += f; H[6] += g; H[7] += h;
+            }
+
+            return {
+                update: function(bytes) {
+                    let i = 0;
+                    total += bytes.length;
+                    if (blockLength) {
+                        while (blockLength < 64 && i < bytes.length) {
+                            block[blockLength++] = bytes[i++];
+                        }
+                        if (blockLength < 64) {
+                            return;
+                        }
+                        compress(block, 0);
+                        blockLength = 0;
+                    }
+                    for (; i + 64 <= bytes.length; i += 64) {
+                        compress(bytes, i);
+                    }
+                    while (i < bytes.length) {
+                        block[blockLength++] = bytes[i++];
+                    }
+                },
+                digest: function() {
+                    block[blockLength++] = 0x80;
+                    if (blockLength > 56) {
+                        block.fill(0, blockLength);
+                        compress(block, 0);
+                        blockLength = 0;
+                    }
+                    block.fill(0, blockLength);
+                    const view = new DataView(block.buffer);
+                    view.setUint32(56, Math.floor(total / 0x20000000));
+                    view.setUint32(60, (total * 8) >>> 0);
+                    compress(block, 0);
+                    return Array.from(H, x => x.toString(16).padStart(8, '0')).join('');
+                }
+            };
+        }
+
+        onmessage = async function(event) {
+            const hash = sha256();
+            // 持有证明: 随机数和服务器挑选的几段内容一起算摘要
+            if (event.data.challenge) {
+                const challenge = event.data.challenge;
+                hash.update(new Uint8Array(challenge.nonce.match(/../g).map(byte => parseInt(byte, 16))));
+                for (const range of challenge.ranges) {
+                    hash.update(new Uint8Array(await event.data.file.slice(range[0], range[1]).arrayBuffer()));
+                }
+                postMessage({ proof: hash.digest() });
+                return;
+            }
+            const file = event.data;
+            const chunkSize = 4 * 1024 * 1024;
+            for (let offset = 0; offset < file.size; offset += chunkSize) {
+                hash.update(new Uint8Array(await file.slice(offset, offset + chunkSize).arrayBuffer()));
+                postMessage({ hashed: Math.min(offset + chunkSize, file.size) });
+            }
+            postMessage({ digest: hash.digest() });
+        };
+    `;
+
+    function hashFiles(files, report) {
+        const worker = new Worker(URL.createObjectURL(new Blob([hashWorkerSource], { type: 'text/javascript' })));
+        const digests = [];
+        let done = 0;
+        return new Promise((resolve, reject) => {
+            worker.onmessage = function(event) {
+                if (event.data.digest) {
+                    done += files[digests.length].size;
+                    digests.push(event.data.digest);
+                    if (digests.length < files.length) {
+                        worker.postMessage(files[digests.length]);
+                    } else {
+                        worker.terminate();
+                        resolve(digests);
+                    }
+                } else {
+                    report(done + event.data.hashed);
+                }
+            };
+            worker.onerror = function(error) {
+                worker.terminate();
+                reject(error);
+            };
+            worker.postMessage(files[0]);
+        });
+    }
+
+    // 回答服务器对已有内容的挑战，答对的文件不用再发送；出错时照常上传
+    async function proveFiles(uploadId, files, status) {
+        const pending = files.map((file, index) => index).filter(index => status[index].challenge);
+        if (!pending.length) {
+            return;
+        }
+        const worker = new Worker(URL.createObjectURL(new Blob([hashWorkerSource], { type: 'text/javascript' })));
+        try {
+            for (const index of pending) {
+                const proof = await new Promise((resolve, reject) => {
+                    worker.onmessage = event => resolve(event.data.proof);
+                    worker.onerror = reject;
+                    worker.postMessage({ file: files[index], challenge: status[index].challenge });
+                });
+                const result = await fetch('/upload/' + uploadId + '/' + index + '/proof', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({ proof: proof })
+                }).then(response => response.json());
+                status[index].exists = Boolean(result.exists);
+            }
+        } catch (error) {
+            console.error('错误:', error);
+        } finally {
+            worker.terminate();
+        }
+    }
+
+    const crcTable = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+        }
+        crcTable[n] = c;
+    }
+
+    function crc32(bytes) {
+        let crc = 0xFFFFFFFF;
+        for (let i = 0; i < bytes.length; i++) {
+            crc = crcTable[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+        }
+        return ((crc ^ 0xFFFFFFFF) >>> 0).toString(16);
+    }
+
+    // 发送一个分块
+    function putChunk(uploadId, index, offset, bytes) {
+        return new Promise((resolve, reject) => {
+            const xhr = new XMLHttpRequest();
+            xhr.open('PUT', '/upload/' + uploadId + '/' + index + '?offset=' + offset, true);
+            xhr.setRequestHeader('X-Chunk-CRC32', crc32(bytes));
+            xhr.onload = function() {
+                if (xhr.status === 200) {
+                    resolve(JSON.parse(xhr.responseText));
+                } else {
+                    reject(new Error(xhr.status));
+                }
+            };
+            xhr.onerror = function() {
+                reject(new Error('network'));
+            };
+            xhr.send(bytes);
+        });
+    }
+
+    async function uploadStatus(uploadId) {
+        const response = await fetch('/upload/' + uploadId);
+        if (!response.ok) {
+            throw new Error(response.status);
+        }
+        return response.json();
+    }
+
+    function isReceived(ranges, start, end) {
+        return ranges.some(range => range[0] <= start && end <= range[1]);
+    }
+
+    // 多个连接并发发送各文件的分块，失败的分块查询服务器已收到的范围后重发
+    async function sendChunks(uploadId, files, status, chunkSize, parallel, report) {
+        const queue = [];
+        let done = 0;
+        files.forEach(function(file, index) {
+            // 服务器上已有相同内容的文件不用再发送
+            if (status[index].exists) {
+                done += file.size;
+                return;
+            }
+            for (let offset = 0; offset < file.size; offset += chunkSize) {
+                queue.push({ index: index, offset: offset, end: Math.min(offset + chunkSize, file.size) });
+            }
+        });
+        let failures = 0;
+
+        async function worker() {
+            while (queue.length) {
+                const chunk = queue.shift();
+                try {
+                    const bytes = new Uint8Array(await files[chunk.index].slice(chunk.offset, chunk.end).arrayBuffer());
+                    await putChunk(uploadId, chunk.index, chunk.offset, bytes);
+                    done += chunk.end - chunk.offset;
+                    report(done);
+                } catch (error) {
+                    if (++failures > 10 * parallel) {
+                        throw error;
+                    }
+                    message.textContent = '网络中断，正在重试...';
+                    await sleep(Math.min(1000 * failures, 10000));
+                    try {
+                        const status = await uploadStatus(uploadId);
+                        if (isReceived(status.files[chunk.index].ranges, chunk.offset, chunk.end)) {
+                            done += chunk.end - chunk.offset;
+                            continue;
+                        }
+                        message.textContent = '文件发送中，请稍候...';
+                    } catch (statusError) {
+                    }
+                    queue.push(chunk);
+                }
+            }
+        }
+
+        const workers = [];
+        for (let i = 0; i < parallel; i++) {
+            workers.push(worker());
+        }
+        await Promise.all(workers);
+    }
+
+    // 进度条显示服务器端的进度: 接收、校验、生成链接；不支持 EventSource 时按服务器确认的分块显示
+    const phaseMessages = {
+        ingest: '文件发送中，请稍候...',
+        hash: '服务器正在校验文件...',
+        bundle: '正在生成下载链接...'
+    };
+
+    function showState(state) {
+        if (phaseMessages[state.phase]) {
+            message.textContent = phaseMessages[state.phase];
+            showProgress(state.total ? Math.round(state.done / state.total * 100) : 100);
+        }
+    }
+
+    // 异步引擎下用事件流接收进度；同步服务器上事件流会一直占着一个工作线程，改为定时查询
+    function watchProgress(progressId) {
+        if (document.body.dataset.progress === 'events' && window.EventSource) {
+            const source = new EventSource('/progress/' + progressId + '/events');
+            source.onmessage = function(event) {
+                showState(JSON.parse(event.data));
+            };
+            // 服务器在上传结束后关闭事件流，不自动重连
+            source.onerror = function() {
+                source.close();
+            };
+            return source;
+        }
+        let stopped = false;
+        const timer = setInterval(function() {
+            fetch('/progress/' + progressId)
+                .then(response => response.ok ? response.json() : null)
+                .then(state => {
+                    if (stopped || !state) {
+                        return;
+                    }
+                    showState(state);
+                    if (state.phase === 'done' || state.phase === 'failed') {
+                        poller.close();
+                    }
+                })
+                .catch(error => console.error('错误:', error));
+        }, Number(document.body.dataset.progressInterval) || 1000);
+        const poller = {
+            close: function() {
+                stopped = true;
+                clearInterval(timer);
+            }
+        };
+        return poller;
+    }
+
+    form.onsubmit = async function(event) {
+        event.preventDefault();
+        const files = Array.from(form.elements['files'].files);
+        const total = files.reduce((sum, file) => sum + file.size, 0);
+        let source = null;
+
+        try {
+            let digests = [];
+            if (window.Worker && files.length) {
+                message.textContent = '正在计算文件校验值...';
+                try {
+                    digests = await hashFiles(files, function(hashed) {
+                        showProgress(total ? Math.round(hashed / total * 100) : 100);
+                    });
+                } catch (error) {
+                    console.error('错误:', error);
+                }
+                showProgress(0);
+            }
+            message.textContent = '文件发送中，请稍候...';
+
+            const init = await fetch('/upload/init', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    files: files.map((file, i) => ({ name: file.name, size: file.size, sha256: digests[i] })),
+                    ttl: form.elements['ttl'].value,
+                    max_downloads: form.elements['max_downloads'].value
+                })
+            }).then(response => response.json());
+            if (!init.success) {
+                throw new Error(init.message);
+            }
+
+            await proveFiles(init.upload_id, files, init.files);
+            source = watchProgress(init.upload_id);
+            await sendChunks(init.upload_id, files, init.files, init.chunk_size, init.parallel, function(done) {
+                if (!source) {
+                    showProgress(total ? Math.round(done / total * 100) : 100);
+                }
+            });
+
+            const response = await fetch('/upload/' + init.upload_id + '/finalize', { method: 'POST' })
+                .then(response => response.json());
+            if (response.success) {
+                showProgress(100);
+                downloadLink.innerHTML = '下载链接: <a href="' + response.download_link + '">' + response.download_link + '</a>';
+                pickupCode.textContent = '取件码: ' + response.pickup_code;
+                message.textContent = '文件发送成功！';
+                setTimeout(function() {
+                    location.reload();
+                }, 5000);
+                // 调整页面刷新时间
+            } else {
+                message.textContent = '文件发送失败，请稍后再试';
+            }
+        } catch (error) {
+            console.error('错误:', error);
+            message.textContent = '文件发送失败，请稍后再试';
+        } finally {
+            if (source) {
+                source.close();
+            }
+        }
+    };
+
+    // 历史记录从新到旧按页加载，滚动到列表底部时再取下一页
+    let historyNext = 0;
+    let historyLoading = false;
+
+    async function loadHistory() {
+        if (historyLoading || historyNext === null) {
+            return;
+        }
+        historyLoading = true;
+        try {
+            const page = await fetch('/history' + (historyNext ? '?before=' + historyNext : ''))
+                .then(response => response.json());
+            page.items.forEach(function(item) {
+                const li = document.createElement('li');
+                const link = document.createElement('a');
+                link.href = item.link;
+                link.textContent = item.filename;
+                li.appendChild(link);
+                li.appendChild(document.createTextNode(' (取件码: ' + item.pickup_code + ')'));
+                historyItems.appendChild(li);
+            });
+            historyNext = page.next;
+        } catch (error) {
+            console.error('错误:', error);
+            return;
+        } finally {
+            historyLoading = false;
+        }
+        // 列表还没有填满时不会出现滚动条，继续加载
+        if (historyList.scrollHeight <= historyList.clientHeight) {
+            loadHistory();
+        }
+    }
+
+    historyList.addEventListener('scroll', function() {
+        if (historyList.scrollTop + historyList.clientHeight >= historyList.scrollHeight - 50) {
+            loadHistory();
+        }
+    });
+    loadHistory();
+
+    const pickupForm = document.getElementById('pickup-form');
+    pickupForm.onsubmit = function(event) {
+        event.preventDefault();
+        const pickupCodeValue = pickupForm.elements['pickup_code'].value;
+
+        // 发送取件码请求
+        fetch('/download/pickup', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Accept': 'application/json',
+            },
+            body: new URLSearchParams({ pickup_code: pickupCodeValue })
+        })
+        .then(response => response.json().catch(() => ({})).then(data => {
+            if (response.ok && data.download_link) {
+                window.location.href = data.download_link; // 下载文件
+            } else {
+                // 输错次数过多时服务器暂时拒绝查询
+                errorMessage.textContent = response.status === 429 ? '尝试次数过多，请稍后再试。' : '无效的取件码，请重新输入。';
+                errorMessage.style.display = 'block'; // 显示错误提示
+            }
+        }))
+        .catch(error => {
+            console.error('错误:', error);
+            errorMessage.textContent = '无效的取件码，请重新输入。';
+            errorMessage.style.display = 'block'; // 显示错误提示
+        });
+    };
+});
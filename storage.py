@@ -0,0 +1,302 @@
+# blob 存储后端: 按键 (内容摘要) 存取，本地磁盘和 S3 兼容的对象存储两种实现，接口相同
+#   put_file(key, path)        存入写好的暂存文件，成功后暂存文件不再存在
+#   put_stream(key, stream, size=None)  从可读对象读到结束为止；知道总大小时传入 size，对象存储据此决定分段大小
+#   get_range(key, start, stop, block_size)  逐块读出 [start, stop)
+#   open(key)                  可 seek 的只读文件对象
+#   delete(key)
+#   stat(key)                  返回带 st_size / st_mtime 的对象，不存在时返回 None
+#   scan()                     列出所有的 (键, 修改时间)，用于核对残留文件
+#   local_path(key)            本地文件路径，可以用 sendfile 直接发送；对象存储返回 None
+# 出错时统一抛出 OSError
+import logging
+import os
+import re
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+ObjectStat = namedtuple('ObjectStat', 'st_size st_mtime')
+
+
+def read_full(stream, size):
+    # 网络流一次可能只返回一部分，读满 size 字节或到结尾为止
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return bytes(data)
+
+
+class LocalStorage:
+    is_local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        # 按键的前两个字节分两级目录，每级 256 个，单个目录里的文件数不会随总量无限增长
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def prepare(self):
+        # 旧版本的 blob 平铺在 blobs/ 下，启动时移到分片目录；改名在同一文件系统内完成，很快
+        os.makedirs(self.root, exist_ok=True)
+        moved = 0
+        for entry in os.scandir(self.root):
+            if entry.is_file() and re.fullmatch('[0-9a-f]{64}', entry.name):
+                path = self.path(entry.name)
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(entry.path, path)
+                    moved += 1
+                except OSError:
+                    # 多个工作进程同时启动时可能已被别的进程移走
+                    continue
+        if moved:
+            logging.info(f'存储目录已升级为分片结构: {moved} 个文件')
+
+    def put_file(self, key, path):
+        # 暂存文件写完后改名进入存储，不会出现写了一半的 blob
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    def put_stream(self, key, stream, size=None):
+        # 本地文件不分段，用不到 size
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    data = stream.read(1024 * 1024)
+                    if not data:
+                        break
+                    f.write(data)
+            os.replace(temp, target)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def get_range(self, key, start, stop, block_size):
+        with open(self.path(key), 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        os.remove(self.path(key))
+
+    def stat(self, key):
+        try:
+            return os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def scan(self):
+        for top in os.scandir(self.root):
+            if not top.is_dir():
+                continue
+            for sub in os.scandir(top.path):
+                if sub.is_dir():
+                    for entry in os.scandir(sub.path):
+                        yield entry.name, entry.stat().st_mtime
+
+    def local_path(self, key):
+        return self.path(key)
+
+
+class ObjectReader:
+    # 对象存储上的只读文件: 顺序读取共用一个流式 GET，seek 到别处后从新位置重新发起
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.position = 0
+        self.body = None
+
+    def read(self, size=-1):
+        if self.body is None:
+            self.body = self.storage._get(self.key, self.position)
+            if self.body is None:
+                return b''
+        with self.storage._errors(self.key):
+            data = self.body.read(None if size is None or size < 0 else size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET:
+            raise OSError('对象存储的文件不支持从末尾定位')
+        if offset != self.position:
+            self._release()
+            self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def _release(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def close(self):
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class S3Storage:
+    # S3 兼容的对象存储 (AWS S3、MinIO 等)，需要 boto3；对象键为 prefix + 键
+    # 大文件分段上传，每段至少 part_size 字节；下载用带 Range 的 GET 边收边发
+    is_local = False
+    MAX_PARTS = 10000
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 part_size=8 * 1024 * 1024, connections=64):
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        self.boto3 = boto3
+        self.ClientError = ClientError
+        self.error_types = (BotoCoreError, ClientError)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.options = {
+            'endpoint_url': endpoint_url or None,
+            'region_name': region or None,
+            'aws_access_key_id': access_key or None,
+            'aws_secret_access_key': secret_key or None,
+            'config': Config(max_pool_connections=connections),
+        }
+        self.part_size = part_size
+        self.client = None
+        self.pid = None
+
+    def _client(self):
+        # 连接池不能跨 fork 共用，每个进程各建一个客户端；客户端本身可以多线程共用
+        if self.client is None or self.pid != os.getpid():
+            self.client = self.boto3.session.Session().client('s3', **self.options)
+            self.pid = os.getpid()
+        return self.client
+
+    @contextmanager
+    def _errors(self, key):
+        try:
+            yield
+        except self.error_types as e:
+            raise OSError(f'对象存储访问失败: {key}: {e}') from e
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _get(self, key, start, stop=None):
+        # 返回响应体；起点已在对象末尾时返回 None
+        byte_range = f'bytes={start}-{stop - 1}' if stop is not None else f'bytes={start}-'
+        with self._errors(key):
+            try:
+                return self._client().get_object(Bucket=self.bucket, Key=self.prefix + key, Range=byte_range)['Body']
+            except self.ClientError as e:
+                if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                    return None
+                raise
+
+    def prepare(self):
+        with self._errors(self.bucket):
+            self._client().head_bucket(Bucket=self.bucket)
+
+    def put_file(self, key, path):
+        with open(path, 'rb') as f:
+            self.put_stream(key, f, os.fstat(f.fileno()).st_size)
+        os.remove(path)
+
+    def put_stream(self, key, stream, size=None):
+        client = self._client()
+        name = self.prefix + key
+        # 已知大小时放大分段，保证不超过 S3 的分段数上限
+        part_size = max(self.part_size, -(-size // self.MAX_PARTS)) if size else self.part_size
+        with self._errors(key):
+            data = read_full(stream, part_size)
+            if len(data) < part_size:
+                client.put_object(Bucket=self.bucket, Key=name, Body=data)
+                return
+            upload_id = client.create_multipart_upload(Bucket=self.bucket, Key=name)['UploadId']
+            parts = []
+            try:
+                while data:
+                    number = len(parts) + 1
+                    response = client.upload_part(Bucket=self.bucket, Key=name, UploadId=upload_id,
+                                                  PartNumber=number, Body=data)
+                    parts.append({'ETag': response['ETag'], 'PartNumber': number})
+                    data = read_full(stream, part_size)
+                client.complete_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id,
+                                                 MultipartUpload={'Parts': parts})
+            except BaseException:
+                client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id)
+                raise
+
+    def get_range(self, key, start, stop, block_size):
+        if start >= stop:
+            return
+        body = self._get(key, start, stop)
+        if body is None:
+            return
+        try:
+            with self._errors(key):
+                yield from body.iter_chunks(block_size)
+        finally:
+            body.close()
+
+    def open(self, key):
+        return ObjectReader(self, key)
+
+    def delete(self, key):
+        with self._errors(key):
+            self._client().delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def stat(self, key):
+        with self._errors(key):
+            try:
+                response = self._client().head_object(Bucket=self.bucket, Key=self.prefix + key)
+            except self.ClientError as e:
+                if self._missing(e):
+                    return None
+                raise
+        return ObjectStat(response['ContentLength'], response['LastModified'].timestamp())
+
+    def scan(self):
+        paginator = self._client().get_paginator('list_objects_v2')
+        with self._errors(self.prefix):
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+                for item in page.get('Contents', []):
+                    yield item['Key'][len(self.prefix):], item['LastModified'].timestamp()
+
+    def local_path(self, key):
+        return None
+
+
+def create_storage(config):
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(os.path.join(config['UPLOAD_FOLDER'], 'blobs'))
+    if backend == 's3':
+        return S3Storage(config['S3_BUCKET'], config['S3_PREFIX'], config['S3_ENDPOINT_URL'], config['S3_REGION'],
+                         config['S3_ACCESS_KEY'], config['S3_SECRET_KEY'], config['S3_PART_SIZE'],
+                         config['S3_CONNECTIONS'])
+    raise ValueError(f'不支持的存储后端: {backend}')
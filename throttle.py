@@ -0,0 +1,139 @@
+# 下载限速: 令牌桶 + 加权公平分配
+# 每个下载流依次受 连接 / IP / 链接 三级令牌桶限制；全站带宽按权重在活跃的流之间分配，
+# 受自身上限约束用不完的份额再分给其他流 (water-filling)。
+# reserve 只登记用量并返回需要等待的秒数，同步代码 sleep、异步代码 await asyncio.sleep 均可
+import threading
+import time
+
+
+class TokenBucket:
+    # rate 为每秒字节数，0 表示不限；允许透支，透支部分换算成等待时间
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate, now):
+        self._refill(now)
+        self.rate = rate
+
+    def reserve(self, size, now):
+        if not self.rate:
+            return 0
+        self._refill(now)
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Stream:
+    def __init__(self, shaper, ip, transfer, weight, buckets, fair):
+        self.shaper = shaper
+        self.ip = ip
+        self.transfer = transfer
+        self.weight = weight
+        self.buckets = buckets
+        self.fair = fair
+        self.cap = 0
+        self.closed = False
+
+    def reserve(self, size):
+        return self.shaper.reserve(self, size)
+
+    def close(self):
+        self.shaper.close(self)
+
+
+class Shaper:
+    # 各级限速为 0 时不限；全部为 0 时 open 返回 None，调用方直接跳过限速
+    def __init__(self, connection=0, ip=0, transfer=0, total=0, burst=512 * 1024):
+        self.connection = connection
+        self.ip = ip
+        self.transfer = transfer
+        self.total = total
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.streams = set()
+        # IP 和链接的令牌桶只在有活跃的流时保留: key -> [令牌桶, 流数量]
+        self.ip_buckets = {}
+        self.transfer_buckets = {}
+
+    @property
+    def enabled(self):
+        return bool(self.connection or self.ip or self.transfer or self.total)
+
+    def _acquire(self, table, key, rate):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = [TokenBucket(rate, self.burst), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release(self, table, key):
+        entry = table[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del table[key]
+
+    def open(self, ip, transfer, weight=1):
+        if not self.enabled:
+            return None
+        with self.lock:
+            buckets = [TokenBucket(self.connection, self.burst)]
+            if self.ip:
+                buckets.append(self._acquire(self.ip_buckets, ip, self.ip))
+            if self.transfer:
+                buckets.append(self._acquire(self.transfer_buckets, transfer, self.transfer))
+            stream = Stream(self, ip, transfer, weight, buckets, TokenBucket(0, self.burst))
+            self.streams.add(stream)
+            self._rebalance()
+        return stream
+
+    def close(self, stream):
+        with self.lock:
+            if stream.closed:
+                return
+            stream.closed = True
+            self.streams.discard(stream)
+            if self.ip:
+                self._release(self.ip_buckets, stream.ip)
+            if self.transfer:
+                self._release(self.transfer_buckets, stream.transfer)
+            self._rebalance()
+
+    def reserve(self, stream, size):
+        now = time.monotonic()
+        with self.lock:
+            return max(stream.fair.reserve(size, now), *(bucket.reserve(size, now) for bucket in stream.buckets))
+
+    def _cap(self, stream):
+        # 流自身能达到的最高速率: 共用的 IP / 链接限速按流数量平分
+        caps = [self.connection] if self.connection else []
+        if self.ip:
+            caps.append(self.ip / self.ip_buckets[stream.ip][1])
+        if self.transfer:
+            caps.append(self.transfer / self.transfer_buckets[stream.transfer][1])
+        return min(caps) if caps else 0
+
+    def _rebalance(self):
+        # 有流加入或结束时重新分配全站带宽: 上限低的流先拿满，剩下的按权重分给其余的流
+        if not self.total:
+            return
+        now = time.monotonic()
+        for stream in self.streams:
+            stream.cap = self._cap(stream)
+        remaining = self.total
+        weights = sum(stream.weight for stream in self.streams)
+        for stream in sorted(self.streams, key=lambda s: s.cap / s.weight if s.cap else float('inf')):
+            share = remaining * stream.weight / weights
+            if stream.cap and stream.cap < share:
+                share = stream.cap
+            # 份额为 0 的令牌桶会被当成不限速，至少留 1 字节/秒
+            stream.fair.set_rate(max(share, 1), now)
+            remaining -= share
+            weights -= stream.weight
@@ -0,0 +1,292 @@
+# 边读边生成 ZIP 数据流，不在磁盘上生成中间压缩包
+import bz2
+import os
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_DIR_SIGNATURE = 0x02014b50
+ZIP64_END_SIGNATURE = 0x06064b50
+ZIP64_LOCATOR_SIGNATURE = 0x07064b50
+END_SIGNATURE = 0x06054b50
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+CODECS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+}
+
+# 已经压缩过的常见格式: (偏移, 魔数)，这些文件直接存储不再压缩
+COMPRESSED_SIGNATURES = [
+    (0, b'\xff\xd8\xff'),              # JPEG
+    (0, b'\x89PNG\r\n\x1a\n'),         # PNG
+    (0, b'GIF8'),                      # GIF
+    (8, b'WEBP'),                      # WebP
+    (4, b'ftyp'),                      # MP4 / MOV / M4A / HEIC
+    (0, b'\x1a\x45\xdf\xa3'),          # MKV / WebM
+    (0, b'ID3'),                       # MP3
+    (0, b'\xff\xfb'),                  # MP3
+    (0, b'OggS'),                      # Ogg
+    (0, b'fLaC'),                      # FLAC
+    (0, b'PK\x03\x04'),                # ZIP / docx / xlsx / apk / jar
+    (0, b'\x1f\x8b'),                  # gzip
+    (0, b'BZh'),                       # bzip2
+    (0, b'\xfd7zXZ\x00'),              # xz
+    (0, b'7z\xbc\xaf\x27\x1c'),        # 7z
+    (0, b'Rar!\x1a\x07'),              # RAR
+    (0, b'\x28\xb5\x2f\xfd'),          # zstd
+    (0, b'\x04\x22\x4d\x18'),          # lz4
+]
+
+PROBE_SAMPLES = 4
+PROBE_SIZE = 32 * 1024
+PROBE_RATIO = 0.9
+
+# deflate 的回溯窗口大小，并行压缩时每块用上一块的末尾作为字典
+DEFLATE_WINDOW = 32 * 1024
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (0 << 9) | (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def encode_name(arcname):
+    try:
+        return arcname.encode('ascii'), 0
+    except UnicodeEncodeError:
+        return arcname.encode('utf-8'), FLAG_UTF8
+
+
+def get_executor(workers):
+    # 同样线程数的下载共用一个线程池，zlib 压缩时会释放 GIL，线程即可用满多核
+    with _executor_lock:
+        if workers not in _executors:
+            _executors[workers] = ThreadPoolExecutor(workers, thread_name_prefix='zipstream')
+        return _executors[workers]
+
+
+def deflate_block(data, level, dictionary, last):
+    # 非最后一块以 Z_SYNC_FLUSH 结束（按字节对齐且不带结束标记），各块直接拼接即为一个完整的 deflate 流
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def is_compressible(f, size):
+    # f 为已打开的文件，检查完后回到开头
+    head = f.read(64)
+    for offset, magic in COMPRESSED_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            f.seek(0)
+            return False
+
+    # 在文件中均匀取几段样本做一次快速压缩，压不下去的按不可压缩处理；
+    # 小文件整个拿来试，样本不能重叠，否则重复的内容会让随机数据也显得可压缩
+    sample = bytearray()
+    if size <= PROBE_SAMPLES * PROBE_SIZE:
+        f.seek(0)
+        sample += f.read(size)
+    else:
+        for i in range(PROBE_SAMPLES):
+            f.seek(size * i // PROBE_SAMPLES)
+            sample += f.read(PROBE_SIZE)
+    f.seek(0)
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * PROBE_RATIO
+
+
+class ZipStream:
+    # entries: [(文件路径, 压缩包内文件名), ...]；给了 storage 时第一项为存储后端中的键
+    # 每个条目先写本地文件头，数据之后用数据描述符补上 CRC 和大小，需要时使用 ZIP64
+    # codec 为 CODECS 中的一种；detect 为 True 时不可压缩的文件直接存储
+    # workers 大于 1 时 deflate 按块分给线程池并行压缩，可跨越多个条目提前压缩
+    def __init__(self, entries, codec='deflate', level=6, detect=True, block_size=1024 * 1024, workers=1,
+                 storage=None):
+        if codec not in CODECS:
+            raise ValueError(f'不支持的压缩方式: {codec}')
+        self.entries = entries
+        self.storage = storage
+        self.compression = CODECS[codec]
+        self.level = level
+        self.detect = detect
+        self.block_size = block_size
+        self.workers = workers
+        self.offset = 0
+        self.records = []
+        self.current = None
+
+    def __iter__(self):
+        # 读文件和提交压缩的一方最多领先输出 depth 步
+        depth = self.workers * 2 if self.workers > 1 else 0
+        window = deque()
+        for step in self._read_entries():
+            window.append(step)
+            while len(window) > depth:
+                yield from self._write_step(window.popleft())
+        while window:
+            yield from self._write_step(window.popleft())
+        yield self._end_records()
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def _open(self, source):
+        if self.storage is None:
+            return open(source, 'rb'), os.stat(source)
+        st = self.storage.stat(source)
+        if st is None:
+            raise FileNotFoundError(source)
+        return self.storage.open(source), st
+
+    def _method(self, f, size):
+        if self.compression == zipfile.ZIP_STORED or not size:
+            return zipfile.ZIP_STORED
+        if self.detect and not is_compressible(f, size):
+            return zipfile.ZIP_STORED
+        return self.compression
+
+    def _compressor(self, method):
+        if method == zipfile.ZIP_DEFLATED:
+            return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        if method == zipfile.ZIP_BZIP2:
+            return bz2.BZ2Compressor(self.level)
+        return None
+
+    def _read_entries(self):
+        # 依次产生 ('entry', ...)、若干 ('data', 字节或 Future)、('end', crc, 大小)
+        for source, arcname in self.entries:
+            f, st = self._open(source)
+            with f:
+                method = self._method(f, st.st_size)
+                yield 'entry', arcname, st, method
+
+                crc = 0
+                file_size = 0
+                if method == zipfile.ZIP_DEFLATED and self.workers > 1:
+                    executor = get_executor(self.workers)
+                    dictionary = None
+                    data = f.read(self.block_size)
+                    if not data:
+                        yield 'data', deflate_block(b'', self.level, None, True)
+                    while data:
+                        next_data = f.read(self.block_size)
+                        crc = zlib.crc32(data, crc)
+                        file_size += len(data)
+                        yield 'data', executor.submit(deflate_block, data, self.level, dictionary, not next_data)
+                        dictionary = data[-DEFLATE_WINDOW:]
+                        data = next_data
+                else:
+                    compressor = self._compressor(method)
+                    while True:
+                        data = f.read(self.block_size)
+                        if not data:
+                            break
+                        crc = zlib.crc32(data, crc)
+                        file_size += len(data)
+                        yield 'data', compressor.compress(data) if compressor else data
+                    if compressor:
+                        yield 'data', compressor.flush()
+            yield 'end', crc, file_size
+
+    def _write_step(self, step):
+        kind = step[0]
+        if kind == 'entry':
+            yield self._write_header(*step[1:])
+        elif kind == 'data':
+            data = step[1].result() if isinstance(step[1], Future) else step[1]
+            if data:
+                self.current['compress_size'] += len(data)
+                yield self._emit(data)
+        else:
+            yield self._write_descriptor(*step[1:])
+
+    def _write_header(self, arcname, st, method):
+        name, flags = encode_name(arcname)
+        flags |= FLAG_DATA_DESCRIPTOR
+        # 与 zipfile 相同：压缩后可能略大，预留 5% 判断是否需要 ZIP64
+        zip64 = st.st_size * 1.05 > zipfile.ZIP64_LIMIT
+        version = zipfile.DEFAULT_VERSION
+        if method == zipfile.ZIP_BZIP2:
+            version = zipfile.BZIP2_VERSION
+        if zip64:
+            version = max(version, zipfile.ZIP64_VERSION)
+        dos_time, dos_date = dos_datetime(st.st_mtime)
+        self.current = {
+            'name': name, 'flags': flags, 'method': method, 'version': version, 'zip64': zip64,
+            'dos_time': dos_time, 'dos_date': dos_date, 'header_offset': self.offset, 'compress_size': 0,
+        }
+
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            size_field = 0xFFFFFFFF
+        else:
+            extra = b''
+            size_field = 0
+        return self._emit(struct.pack('<IHHHHHIIIHH', LOCAL_HEADER_SIGNATURE, version, flags, method,
+                                      dos_time, dos_date, 0, size_field, size_field, len(name), len(extra))
+                          + name + extra)
+
+    def _write_descriptor(self, crc, file_size):
+        entry = self.current
+        compress_size = entry['compress_size']
+        if entry['zip64']:
+            descriptor = struct.pack('<IIQQ', DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size)
+        else:
+            descriptor = struct.pack('<IIII', DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size)
+
+        self.records.append((entry['name'], entry['flags'], entry['method'], entry['version'], entry['dos_time'],
+                             entry['dos_date'], crc, compress_size, file_size, entry['header_offset']))
+        return self._emit(descriptor)
+
+    def _end_records(self):
+        central = []
+        for name, flags, method, version, dos_time, dos_date, crc, compress_size, file_size, header_offset in self.records:
+            extra = []
+            if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+                extra.extend((file_size, compress_size))
+                file_size = compress_size = 0xFFFFFFFF
+            if header_offset > zipfile.ZIP64_LIMIT:
+                extra.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra_data = struct.pack('<HH' + 'Q' * len(extra), 1, 8 * len(extra), *extra) if extra else b''
+            if extra:
+                version = max(version, zipfile.ZIP64_VERSION)
+            central.append(struct.pack('<IBBBBHHHHIIIHHHHHII', CENTRAL_DIR_SIGNATURE, version, 3, version, 0,
+                                       flags, method, dos_time, dos_date, crc, compress_size, file_size,
+                                       len(name), len(extra_data), 0, 0, 0, (0o100644 & 0xFFFF) << 16,
+                                       header_offset) + name + extra_data)
+
+        central_dir = b''.join(central)
+        count = len(self.records)
+        cd_offset = self.offset
+        cd_size = len(central_dir)
+        end = []
+        if count > zipfile.ZIP_FILECOUNT_LIMIT or cd_offset > zipfile.ZIP64_LIMIT or cd_size > zipfile.ZIP64_LIMIT:
+            zip64_end_offset = cd_offset + cd_size
+            end.append(struct.pack('<IQHHIIQQQQ', ZIP64_END_SIGNATURE, 44, zipfile.ZIP64_VERSION,
+                                   zipfile.ZIP64_VERSION, 0, 0, count, count, cd_size, cd_offset))
+            end.append(struct.pack('<IIQI', ZIP64_LOCATOR_SIGNATURE, 0, zip64_end_offset, 1))
+        end.append(struct.pack('<IHHHHIIH', END_SIGNATURE, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                               min(cd_size, 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF), 0))
+        return self._emit(central_dir + b''.join(end))